@@ -40,24 +40,25 @@ import math
 import binascii
 from binascii import hexlify, unhexlify
 import zlib
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
-import nacl.encoding
-import nacl.signing
-from nacl.bindings import \
-        crypto_sign_ed25519ph_state, \
-        crypto_sign_ed25519ph_update, \
-        crypto_sign_ed25519ph_final_create
+from signing import Keystore, DaemonSigner, SigningEngine, prehash, \
+        DEFAULT_KEY_NAME
 
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 
 from elf32_structs import \
         Elf32_Ehdr, Elf32_Shdr, Elf32_Sym, Elf32_Rela, \
-        Elf32_SHT_RELA, Elf32_SHT_NOBITS, \
+        Elf32_SHT_PROGBITS, Elf32_SHT_RELA, Elf32_SHT_NOBITS, \
+        Elf32_SHN_LORESERVE, \
         Elf32_SHF_ALLOC, Elf32_SHF_EXECINSTR, \
         Elf32_R_XTENSA_NONE, Elf32_R_XTENSA_32, \
         Elf32_R_XTENSA_ASM_EXPAND, Elf32_R_XTENSA_SLOT0_OP
 from jelf_structs import \
-        Jelf_Ehdr, Jelf_Shdr, Jelf_Sym, Jelf_Rela, \
+        Jelf_Ehdr, Jelf_Shdr, Jelf_Sym, Jelf_Rela, Jelf_Import, \
+        JELF_IDENT, JELF_IDENT_IMPORTS, \
         Jelf_SHT_OTHER, Jelf_SHT_RELA, Jelf_SHT_NOBITS, Jelf_SHT_SYMTAB, \
         Jelf_SHF_ALLOC, Jelf_SHF_EXECINSTR, \
         Jelf_R_XTENSA_NONE, Jelf_R_XTENSA_32, \
@@ -71,12 +72,20 @@ this_path = os.path.dirname(os.path.realpath(__file__))
 HARDEN = 0x80000000
 log = logging.getLogger('elf2jelf')
 
-def compress_data(data):
-    w_bits = 12
+COMPRESSION_W_BITS = 12
+
+def compress_data(data, zdict=None):
+    """
+    Deflates data for the JELFLoader. zdict is an optional preset dictionary
+    the decompressor must also be given (see jelf_bundle.py).
+    """
+    w_bits = COMPRESSION_W_BITS
     level = zlib.Z_BEST_COMPRESSION
     log.info("Compressing at level %d with window (dict) size %d", level, 2**w_bits)
+    kwargs = {} if zdict is None else {'zdict': zdict}
     compressor = zlib.compressobj(level=level, method=zlib.DEFLATED,
-            wbits=w_bits, memLevel=zlib.DEF_MEM_LEVEL, strategy=zlib.Z_DEFAULT_STRATEGY)
+            wbits=w_bits, memLevel=zlib.DEF_MEM_LEVEL, strategy=zlib.Z_DEFAULT_STRATEGY,
+            **kwargs)
     compressed_data = compressor.compress(data)
     compressed_data += compressor.flush()
     compress_percentage = 100*(1-(len(compressed_data)/len(data)))
@@ -112,7 +121,36 @@ def parse_args():
             ''')
     parser.add_argument('--signing_key', type=str,
             default='000102030405060708090A0B0C0D0E0F101112131415161718191A1B1C1D1E1F',
-            help="256-bit private key in hexidecimal (len=64).")
+            help='''
+            256-bit private key in hexidecimal (len=64). Development only;
+            ignored if --keystore or --signing_daemon is given.''')
+    parser.add_argument('--keystore', type=str, default=None,
+            help='''
+            JSON keystore file of named signing keys (see signing.py).''')
+    parser.add_argument('--signing_daemon', type=str, default=None,
+            help='''
+            Unix socket of a running signing daemon (see signing.py).''')
+    parser.add_argument('--key', type=str, default=DEFAULT_KEY_NAME,
+            help='''
+            Name of the key in the keystore or signing daemon to sign with.''')
+    parser.add_argument('--merge_sections', action='store_true',
+            help='''
+            Merge -ffunction-sections/-fdata-sections fragments (.text.*,
+            .literal.*, .rodata.*, ...) with the same flags and alignment
+            to reduce the section count.''')
+    parser.add_argument('--import_table', action='store_true',
+            help='''
+            Emit a table of the distinct exported functions the app uses and
+            index it from st_name, so the loader resolves each export once.''')
+    parser.add_argument('--variants', type=str, default=None,
+            help='''
+            JSON list of variants to produce from a single conversion, e.g.
+            [{"name": "nano", "coin": "44'/165'", "bip32key": "ed25519 seed",
+            "key": "prod"}, ...]. Each variant gets its own header, signature
+            and compressed file; --output, --coin and --bip32key are ignored.''')
+    parser.add_argument('--variants_dir', type=str, default=None,
+            help='''
+            Directory to write variants to. Defaults to the input's directory.''')
     args = parser.parse_args()
     dargs = vars(args)
     return (args, dargs)
@@ -147,6 +185,17 @@ def write_export_header(export_list, major, minor):
     with open(os.path.join(this_path, 'jolt_lib.h'), 'w') as f:
         f.write(jolt_lib)
 
+def get_signer(args):
+    """
+    Returns the Keystore or DaemonSigner selected on the command line
+    """
+    if args.signing_daemon is not None:
+        return DaemonSigner(args.signing_daemon)
+    elif args.keystore is not None:
+        return Keystore.load(args.keystore)
+    else:
+        return Keystore.from_seed(unhexlify(args.signing_key), args.key)
+
 def get_ehdr(elf_contents):
     assert( Elf32_Ehdr.size_bytes() == 52 )
     ehdr = Elf32_Ehdr.unpack(elf_contents[0:])
@@ -195,6 +244,182 @@ def read_section_headers(elf_contents, ehdr, shstrtab):
         elf32_shdr_names.append(shdr_name)
     return elf32_shdrs, elf32_shdr_names, elf32_symtab, elf32_strtab
 
+def section_group_name(name):
+    """
+    Name a -ffunction-sections/-fdata-sections fragment merges into;
+    e.g. b'.text.app_main' -> b'.text'
+    """
+    dot = name.find(b'.', 1)
+    return name if dot < 0 else name[:dot]
+
+def count_loader_allocations(elf32_shdrs, elf32_shdr_names):
+    """
+    Returns (number of JELF sections, estimated JELFLoader allocations).
+    The loader parses every section header and allocates each non-empty
+    SHF_ALLOC section.
+    """
+    n_sections = 0
+    n_allocs = 0
+    for shdr, name in zip(elf32_shdrs, elf32_shdr_names):
+        if name == b'.strtab' or name == b'.shstrtab':
+            continue
+        n_sections += 1
+        if shdr.sh_flags & Elf32_SHF_ALLOC and shdr.sh_size > 0:
+            n_allocs += 1
+    return n_sections, n_allocs
+
+def merge_sections(elf_contents, elf32_shdrs, elf32_shdr_names,
+        elf32_symtab):
+    """
+    Coalesces allocated PROGBITS/NOBITS sections that share a group name
+    (see section_group_name), sh_flags and sh_addralign, along with their
+    RELA sections. Symbol st_value/st_shndx, r_offset and section indices
+    are rewritten to match. Merged sections are kept under 2**16 bytes so
+    JELF's 16-bit r_offset still fits.
+
+    Merged section contents are appended to a copy of elf_contents.
+    returns: elf_contents, elf32_shdrs, elf32_shdr_names, elf32_symtab
+    """
+    max_group_size = 2**16
+
+    # Assign every mergeable section to a group;
+    # group_of[i] = (index of the group's first section, offset in group)
+    group_of = {}
+    group_sizes = {}
+    open_groups = {}
+    for i, (shdr, name) in enumerate(zip(elf32_shdrs, elf32_shdr_names)):
+        if shdr.sh_type not in (Elf32_SHT_PROGBITS, Elf32_SHT_NOBITS) \
+                or not shdr.sh_flags & Elf32_SHF_ALLOC:
+            continue
+        key = (section_group_name(name), shdr.sh_type, shdr.sh_flags,
+                shdr.sh_addralign)
+        head = open_groups.get(key)
+        if head is not None:
+            offset = align(group_sizes[head], max(shdr.sh_addralign, 1))
+            if offset + shdr.sh_size > max_group_size:
+                head = None
+        if head is None:
+            head = i
+            offset = 0
+            open_groups[key] = head
+        group_of[i] = (head, offset)
+        group_sizes[head] = offset + shdr.sh_size
+
+    # RELA sections merge when their target sections merged
+    rela_group_of = {}
+    rela_heads = {}
+    for i, shdr in enumerate(elf32_shdrs):
+        if shdr.sh_type == Elf32_SHT_RELA and shdr.sh_info in group_of:
+            target_head = group_of[shdr.sh_info][0]
+            rela_group_of[i] = rela_heads.setdefault(target_head, i)
+
+    # Build the new section order; merged sections take the place of
+    # their first member
+    new_index = {}
+    kept = []
+    for i in range(len(elf32_shdrs)):
+        if i in group_of:
+            head = group_of[i][0]
+        elif i in rela_group_of:
+            head = rela_group_of[i]
+        else:
+            head = i
+        if head == i:
+            kept.append(i)
+        new_index[i] = new_index.get(head, len(kept) - 1)
+    if len(kept) == len(elf32_shdrs):
+        log.info("No sections to merge")
+        return elf_contents, elf32_shdrs, elf32_shdr_names, elf32_symtab
+
+    def remap_shndx(shndx):
+        if shndx == 0 or shndx >= Elf32_SHN_LORESERVE:
+            return shndx
+        return new_index[shndx]
+
+    merged_contents = bytearray(elf_contents)
+    def append(data):
+        merged_contents.extend(bytes(align(len(merged_contents))
+                - len(merged_contents)))
+        offset = len(merged_contents)
+        merged_contents.extend(data)
+        return offset
+
+    # Concatenate group members' data
+    members = {}
+    for i in sorted(group_of):
+        members.setdefault(group_of[i][0], []).append(i)
+    for i in sorted(rela_group_of):
+        members.setdefault(rela_group_of[i], []).append(i)
+
+    new_shdrs = []
+    new_names = []
+    rela_size = Elf32_Rela.size_bytes()
+    for i in kept:
+        shdr = elf32_shdrs[i]
+        name = elf32_shdr_names[i]
+        # A lone RELA section still needs rebasing when its target was
+        # merged at a nonzero offset, e.g. when the other fragments in the
+        # group are leaf functions without relocations
+        rebase_relas = i in rela_group_of and \
+                len(members[group_of[shdr.sh_info][0]]) > 1
+        if i in members and (len(members[i]) > 1 or rebase_relas):
+            if i in group_of:
+                name = section_group_name(name)
+                size = group_sizes[i]
+                if shdr.sh_type == Elf32_SHT_NOBITS:
+                    offset = shdr.sh_offset
+                else:
+                    data = bytearray(size)
+                    for j in members[i]:
+                        base = group_of[j][1]
+                        data[base:base+elf32_shdrs[j].sh_size] = \
+                                elf_contents[elf32_shdrs[j].sh_offset:
+                                elf32_shdrs[j].sh_offset+elf32_shdrs[j].sh_size]
+                    offset = append(data)
+            else:
+                target_head = group_of[shdr.sh_info][0]
+                name = b'.rela' + section_group_name(
+                        elf32_shdr_names[target_head])
+                data = bytearray()
+                for j in members[i]:
+                    base = group_of[elf32_shdrs[j].sh_info][1]
+                    start = elf32_shdrs[j].sh_offset
+                    for k in range(start, start+elf32_shdrs[j].sh_size,
+                            rela_size):
+                        rela = Elf32_Rela.unpack(elf_contents[k:k+rela_size])
+                        data += Elf32_Rela.pack(rela.r_offset + base,
+                                rela.r_info, rela.r_addend)
+                size = len(data)
+                offset = append(data)
+            shdr = shdr._replace(sh_offset=offset, sh_size=size)
+        if shdr.sh_type == Elf32_SHT_RELA:
+            shdr = shdr._replace(sh_info=remap_shndx(shdr.sh_info))
+        shdr = shdr._replace(sh_link=remap_shndx(shdr.sh_link))
+        new_shdrs.append(shdr)
+        new_names.append(name)
+
+    # Rewrite symbols into their merged sections
+    sym_size = Elf32_Sym.size_bytes()
+    new_symtab = bytearray()
+    for k in range(0, len(elf32_symtab), sym_size):
+        sym = Elf32_Sym.unpack(elf32_symtab[k:k+sym_size])
+        st_value = sym.st_value
+        if sym.st_shndx in group_of:
+            st_value += group_of[sym.st_shndx][1]
+        new_symtab += Elf32_Sym.pack(sym.st_name, st_value, sym.st_size,
+                sym.st_info, sym.st_other, remap_shndx(sym.st_shndx))
+
+    sections_before, allocs_before = count_loader_allocations(
+            elf32_shdrs, elf32_shdr_names)
+    sections_after, allocs_after = count_loader_allocations(
+            new_shdrs, new_names)
+    log.info("Merged sections: %d -> %d sections (%d bytes of section "
+            "headers saved), %d -> %d estimated loader allocations" % \
+            (sections_before, sections_after,
+                (sections_before - sections_after) * Jelf_Shdr.size_bytes(),
+                allocs_before, allocs_after))
+    return bytes(merged_contents), new_shdrs, new_names, bytes(new_symtab)
+
 def convert_shdrs(elf32_shdrs):
     """
     Converts ALL ELF32 Section Headers to JELF Headers
@@ -393,6 +618,70 @@ def write_jelf_sections(elf_contents,
         jelf_ptr = new_jelf_ptr
     return jelf_contents, jelf_ptr, jelf_shdrs
 
+def build_import_table(jelf_symtab, jelf_relas):
+    """
+    Collects the distinct exported functions the app references into an
+    import table and repoints each Jelf_Sym's st_name at its 1-indexed
+    import table slot, so the loader resolves every export once.
+    returns: jelf_symtab, jelf_imports (packed import table)
+    """
+    sym_size = Jelf_Sym.size_bytes()
+    jelf_symtab = bytearray(jelf_symtab)
+    syms = [Jelf_Sym.unpack(jelf_symtab[i:i+sym_size])
+            for i in range(0, len(jelf_symtab), sym_size)]
+
+    export_indices = sorted(set(sym.st_name for sym in syms if sym.st_name))
+    import_slot = {name: i+1 for i, name in enumerate(export_indices)}
+    for i, sym in enumerate(syms):
+        if sym.st_name:
+            jelf_symtab[i*sym_size:(i+1)*sym_size] = Jelf_Sym.pack(
+                    import_slot[sym.st_name], sym.st_shndx, sym.st_value)
+
+    jelf_imports = bytearray()
+    for name in export_indices:
+        jelf_imports += Jelf_Import.pack(name)
+
+    # Every relocation against an export used to cost an export lookup
+    rela_size = Jelf_Rela.size_bytes()
+    n_import_relas = 0
+    for jelf_sec_relas in jelf_relas.values():
+        for i in range(0, len(jelf_sec_relas), rela_size):
+            rela = Jelf_Rela.unpack(jelf_sec_relas[i:i+rela_size])
+            if syms[rela.r_info >> 2].st_name:
+                n_import_relas += 1
+    log.info("Import table: %d imports in %d bytes (+%d byte section "
+            "header); replaces %d export lookups with %d, saving %d" % \
+            (len(export_indices), len(jelf_imports), Jelf_Shdr.size_bytes(),
+                n_import_relas, len(export_indices),
+                max(n_import_relas - len(export_indices), 0)))
+    return jelf_symtab, jelf_imports
+
+def write_jelf_import_table(jelf_contents, jelf_shdrs, jelf_ptr,
+        jelf_imports):
+    """
+    Appends the import table section at jelf_ptr and points the symtab's
+    Section Header at it. The JELF Header must then use JELF_IDENT_IMPORTS.
+    """
+    jelf_shdr_d = OrderedDict()
+    jelf_shdr_d['sh_type']   = Jelf_SHT_OTHER
+    jelf_shdr_d['sh_flags']  = 0
+    jelf_shdr_d['sh_offset'] = jelf_ptr
+    jelf_shdr_d['sh_size']   = len(jelf_imports)
+    jelf_shdr_d['sh_info']   = 0
+    if jelf_ptr > 2**19:
+        raise("Overflow Detected")
+
+    # Index after stripped sections have been filtered out
+    import_shndx = sum(1 for shdr in jelf_shdrs if shdr is not None)
+    for shdr in jelf_shdrs:
+        if shdr is not None and shdr['sh_type'] == Jelf_SHT_SYMTAB:
+            shdr['sh_info'] = import_shndx
+
+    new_jelf_ptr = jelf_ptr + len(jelf_imports)
+    jelf_contents[jelf_ptr:new_jelf_ptr] = jelf_imports
+    jelf_shdrs.append(jelf_shdr_d)
+    return jelf_contents, new_jelf_ptr, jelf_shdrs
+
 def write_jelf_sectionheadertable(jelf_contents,
         jelf_shdrs, jelf_ptr):
     """
@@ -414,38 +703,15 @@ def write_jelf_sectionheadertable(jelf_contents,
     jelf_contents = jelf_contents[:jelf_ptr]
     return jelf_contents, section_count
 
-def main():
-    args, dargs = parse_args()
-
-    signing_key = nacl.signing.SigningKey(unhexlify(args.signing_key))
-
-    global log
-    logging_level = args.verbose.upper()
-    if logging_level == 'INFO':
-        log.setLevel(logging.INFO)
-    elif logging_level == 'DEBUG':
-        log.setLevel(logging.DEBUG)
-    else:
-        raise("Invalid Logging Verbosity")
-
-    ##################################
-    # Read in the JoltOS Export List #
-    ##################################
-    export_list, _JELF_VERSION_MAJOR, _JELF_VERSION_MINOR = read_export_list()
-
-    ###################################
-    # Generate jolt_lib.h export list #
-    ###################################
-    write_export_header(export_list, _JELF_VERSION_MAJOR, _JELF_VERSION_MINOR)
-
-    ####################
-    # Read In ELF File #
-    ####################
-    log.info("Reading in %s" % args.input_elf)
-    with open(args.input_elf, 'rb') as f:
-        elf_contents = f.read()
-    log.info("Read in %d bytes" % len(elf_contents))
-
+def convert_elf(elf_contents, export_list, merge=False, import_table=False):
+    """
+    Converts the contents of an ELF32 file to JELF. The JELF Header is left
+    blank; the caller fills it in and signs.
+    merge: coalesce -ffunction-sections/-fdata-sections fragments
+    import_table: emit an import table of the exports the app uses
+    returns: jelf_contents, jelf_entrypoint_sym_idx, jelf_ehdr_shnum,
+            jelf_shdrtbl
+    """
     #####################
     # Unpack ELF Header #
     #####################
@@ -461,6 +727,10 @@ def main():
     ###########################
     elf32_shdrs, elf32_shdr_names, elf32_symtab, elf32_strtab = \
             read_section_headers( elf_contents, ehdr, shstrtab )
+    if merge:
+        elf_contents, elf32_shdrs, elf32_shdr_names, elf32_symtab = \
+                merge_sections( elf_contents, elf32_shdrs, elf32_shdr_names,
+                        elf32_symtab )
     jelf_shdrs = convert_shdrs( elf32_shdrs )
 
     ###########################################
@@ -475,6 +745,10 @@ def main():
     jelf_relas, jelf_shdrs = convert_relas(elf_contents,
             elf32_shdrs, jelf_shdrs)
 
+    if import_table:
+        jelf_symtab, jelf_imports = build_import_table(jelf_symtab,
+                jelf_relas)
+
     #######################
     # Write JELF Sections #
     #######################
@@ -482,20 +756,27 @@ def main():
             elf32_shdrs, elf32_shdr_names,
             jelf_shdrs, jelf_relas, jelf_symtab)
 
+    if import_table:
+        jelf_contents, jelf_ptr, jelf_shdrs = write_jelf_import_table(
+                jelf_contents, jelf_shdrs, jelf_ptr, jelf_imports)
+
     ##################################################
     # Write Section Header Table to end of JELF File #
     ##################################################
     jelf_shdrtbl = jelf_ptr
     jelf_contents, jelf_ehdr_shnum = write_jelf_sectionheadertable(jelf_contents,
             jelf_shdrs, jelf_ptr)
-    log.info("Jelf Final Size: %d" % len(jelf_contents))
 
-    ###########################
-    # Parse Coin CLI Argument #
-    ###########################
-    if args.coin is None:
-        raise("must specify coin derivation path")
-    purpose_str, coin_str = args.coin.split('/')
+    return jelf_contents, jelf_entrypoint_sym_idx, jelf_ehdr_shnum, \
+            jelf_shdrtbl
+
+def parse_coin(coin_str):
+    """
+    Parses a coin derivation such as "44'/165'" into (purpose, coin)
+    """
+    if coin_str is None:
+        raise ValueError("must specify coin derivation path")
+    purpose_str, coin_str = coin_str.split('/')
     # Check for harden specifier
     if purpose_str[-1] == "'":
         purpose = int(purpose_str[:-1])
@@ -509,56 +790,48 @@ def main():
     else:
         coin = int(coin_str)
     log.info("Coin Path: 0x%08X" % coin)
+    return purpose, coin
 
-    if len(args.bip32key) >= 32:
-        raise("BIP32Key too long!")
-
-    #####################
-    # Write JELF Header #
-    #####################
-    pk = signing_key.verify_key.encode(encoder=nacl.encoding.RawEncoder)
-    sk = signing_key.encode(encoder=nacl.encoding.RawEncoder)
+def make_jelf_ehdr_d(pk, version, jelf_entrypoint_sym_idx, jelf_ehdr_shnum,
+        jelf_shdrtbl, purpose, coin, bip32key, ident=JELF_IDENT):
+    """
+    Returns the JELF Header fields with a placeholder signature
+    ident: JELF_IDENT_IMPORTS if converted with an import table
+    """
     assert(len(pk)==32)
-    assert(len(sk)==32)
+    if len(bip32key) >= 32:
+        raise ValueError("BIP32Key too long!")
 
     jelf_ehdr_d = OrderedDict()
-    jelf_ehdr_d['e_ident']          = '\x7fJELF\x00'
+    jelf_ehdr_d['e_ident']          = ident
     jelf_ehdr_d['e_signature']      = b'\x00'*64           # Placeholder
     jelf_ehdr_d['e_public_key']     = pk
-    jelf_ehdr_d['e_version_major']  = _JELF_VERSION_MAJOR
-    jelf_ehdr_d['e_version_minor']  = _JELF_VERSION_MINOR
+    jelf_ehdr_d['e_version_major']  = version[0]
+    jelf_ehdr_d['e_version_minor']  = version[1]
     jelf_ehdr_d['e_entry_offset']   = jelf_entrypoint_sym_idx
     jelf_ehdr_d['e_shnum']          = jelf_ehdr_shnum
     jelf_ehdr_d['e_shoff']          = jelf_shdrtbl
     jelf_ehdr_d['e_coin_purpose']   = purpose
     jelf_ehdr_d['e_coin_path']      = coin
-    jelf_ehdr_d['e_bip32key']       = args.bip32key
+    jelf_ehdr_d['e_bip32key']       = bip32key
+    return jelf_ehdr_d
 
+def stamp_variant(jelf_contents, jelf_ehdr_d, name_to_sign):
+    """
+    Writes the JELF Header over a copy of the converted contents.
+    returns: jelf_contents, ed25519ph prehash to sign
+    """
+    jelf_contents = bytearray(jelf_contents)
     jelf_contents[:Jelf_Ehdr.size_bytes()] = Jelf_Ehdr.pack(
             *jelf_ehdr_d.values() )
-
-    # Parse Output Filename
-    if args.output is None:
-        path_bn, ext = os.path.splitext(args.input_elf)
-        output_fn = path_bn + '.jelf'
-    else:
-        output_fn = args.output
-    assert(output_fn[-5:]=='.jelf')
-
-    ######################
-    # Generate Signature #
-    ######################
-    log.info("Secret Key: %s", hexlify(sk).decode('utf-8'))
-    log.info("Public Key: %s", hexlify(pk).decode('utf-8'))
-
-    name_to_sign = os.path.basename(output_fn[:-5]).encode('utf-8')
+    log.info("Public Key: %s", hexlify(jelf_ehdr_d['e_public_key']).decode('utf-8'))
     log.info("Signed application name: %s" % name_to_sign)
+    return jelf_contents, prehash(name_to_sign, jelf_contents)
 
-    state = crypto_sign_ed25519ph_state()
-    crypto_sign_ed25519ph_update(state, name_to_sign)
-    crypto_sign_ed25519ph_update(state, bytes(jelf_contents))
-    signature = crypto_sign_ed25519ph_final_create(state, sk+pk)
-
+def sign_variant(jelf_contents, jelf_ehdr_d, signature):
+    """
+    Fills in the signature in the JELF Header of stamped contents
+    """
     assert(len(signature) == 64)
     log.info("Signature: %s", hexlify(signature).decode('utf-8'))
 
@@ -566,19 +839,183 @@ def main():
     jelf_ehdr_d['e_signature'] = signature
     jelf_contents[:Jelf_Ehdr.size_bytes()] = Jelf_Ehdr.pack(
             *jelf_ehdr_d.values() )
+    return jelf_contents
 
-    #############################
-    # Write JELF binary to file #
-    #############################
+def write_variant(jelf_contents, jelf_ehdr_d, signature, output_fn):
+    """
+    Fills in the signature, then writes the .jelf and .jelf.gz files
+    """
+    jelf_contents = sign_variant(jelf_contents, jelf_ehdr_d, signature)
+    return write_jelf_files(bytes(jelf_contents), output_fn)
+
+def write_jelf_files(jelf_contents, output_fn):
+    """
+    Writes signed contents to output_fn and a compressed copy to
+    output_fn.gz
+    """
     with open(output_fn, 'wb') as f:
         f.write(jelf_contents)
 
-    ########################################
-    # Write Compressed JELF binary to file #
-    ########################################
-    compressed_jelf = compress_data(jelf_contents);
+    compressed_jelf = compress_data(jelf_contents)
     with open(output_fn+'.gz', 'wb') as f:
         f.write(compressed_jelf)
+    return output_fn
+
+def build_variants(converted, version, variants, signing_engine, output_dir,
+        default_key=DEFAULT_KEY_NAME, max_workers=None, ident=JELF_IDENT):
+    """
+    Stamps out one signed .jelf/.jelf.gz per variant from a single
+    conversion; only the JELF Header and signature differ between them.
+    converted: return value of convert_elf()
+    ident: JELF_IDENT_IMPORTS if converted with an import table
+    variants: list of dicts with "coin", "bip32key", "key" and "name" keys;
+            "bip32key" defaults to "bitcoin_seed" and "key" to default_key
+    returns: list of output filenames
+    """
+    jelf_contents, jelf_entrypoint_sym_idx, jelf_ehdr_shnum, jelf_shdrtbl = \
+            converted
+    jelf_contents = bytes(jelf_contents)
+
+    # Validate everything before doing any work
+    jobs = []
+    names = set()
+    for variant in variants:
+        name = variant['name']
+        # The name is signed as the output file's basename, so it can't
+        # contain a path
+        if not name or os.sep in name or name != os.path.basename(name):
+            raise ValueError("Variant name \"%s\" is not a plain file name" % \
+                    name)
+        if name in names:
+            raise ValueError("Variant name \"%s\" used more than once" % name)
+        names.add(name)
+        key_name = variant.get('key', default_key)
+        purpose, coin = parse_coin(variant['coin'])
+        jelf_ehdr_d = make_jelf_ehdr_d(signing_engine.public_key(key_name),
+                version, jelf_entrypoint_sym_idx, jelf_ehdr_shnum,
+                jelf_shdrtbl, purpose, coin,
+                variant.get('bip32key', 'bitcoin_seed'), ident)
+        output_fn = os.path.join(output_dir, name + '.jelf')
+        jobs.append((key_name, jelf_ehdr_d, name.encode('utf-8'), output_fn))
+
+    if not jobs:
+        return []
+
+    # Stamping a header and hashing is cheap; keep it out of the pool so
+    # each variant is only sent to a worker once, to be compressed
+    stamped = [stamp_variant(jelf_contents, jelf_ehdr_d, name_to_sign)
+            for key_name, jelf_ehdr_d, name_to_sign, output_fn in jobs]
+    signatures = [signing_engine.submit(job[0], digest)
+            for job, (_, digest) in zip(jobs, stamped)]
+
+    # Spawned rather than forked, so workers never inherit a loaded
+    # Keystore's secret keys
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(jobs)),
+            mp_context=multiprocessing.get_context('spawn')) as pool:
+        written = [pool.submit(write_jelf_files, bytes(sign_variant(
+                contents, job[1], signature.result())), job[3])
+                for job, (contents, _), signature
+                in zip(jobs, stamped, signatures)]
+        output_fns = [future.result() for future in written]
+    log.info("Wrote %d variants to %s" % (len(output_fns), output_dir))
+    return output_fns
+
+def main():
+    args, dargs = parse_args()
+
+    global log
+    logging_level = args.verbose.upper()
+    if logging_level == 'INFO':
+        log.setLevel(logging.INFO)
+    elif logging_level == 'DEBUG':
+        log.setLevel(logging.DEBUG)
+    else:
+        raise("Invalid Logging Verbosity")
+
+    signing_engine = SigningEngine(get_signer(args))
+
+    ##################################
+    # Read in the JoltOS Export List #
+    ##################################
+    export_list, _JELF_VERSION_MAJOR, _JELF_VERSION_MINOR = read_export_list()
+
+    ###################################
+    # Generate jolt_lib.h export list #
+    ###################################
+    write_export_header(export_list, _JELF_VERSION_MAJOR, _JELF_VERSION_MINOR)
+
+    ####################
+    # Read In ELF File #
+    ####################
+    log.info("Reading in %s" % args.input_elf)
+    with open(args.input_elf, 'rb') as f:
+        elf_contents = f.read()
+    log.info("Read in %d bytes" % len(elf_contents))
+
+    ############################
+    # Convert ELF File to JELF #
+    ############################
+    jelf_contents, jelf_entrypoint_sym_idx, jelf_ehdr_shnum, jelf_shdrtbl = \
+            convert_elf(elf_contents, export_list, args.merge_sections,
+                    args.import_table)
+    log.info("Jelf Final Size: %d" % len(jelf_contents))
+    jelf_ident = JELF_IDENT_IMPORTS if args.import_table else JELF_IDENT
+
+    if args.variants is not None:
+        ######################################
+        # Stamp Out Every Variant of the App #
+        ######################################
+        with open(args.variants, 'r') as f:
+            variants = json.load(f)
+        output_dir = args.variants_dir
+        if output_dir is None:
+            output_dir = os.path.dirname(args.input_elf)
+        build_variants( (jelf_contents, jelf_entrypoint_sym_idx,
+                jelf_ehdr_shnum, jelf_shdrtbl),
+                (_JELF_VERSION_MAJOR, _JELF_VERSION_MINOR),
+                variants, signing_engine, output_dir, args.key,
+                ident=jelf_ident)
+        signing_engine.close()
+        log.info("Complete!")
+        return
+
+    ###########################
+    # Parse Coin CLI Argument #
+    ###########################
+    purpose, coin = parse_coin(args.coin)
+
+    #####################
+    # Write JELF Header #
+    #####################
+    pk = signing_engine.public_key(args.key)
+    jelf_ehdr_d = make_jelf_ehdr_d(pk,
+            (_JELF_VERSION_MAJOR, _JELF_VERSION_MINOR),
+            jelf_entrypoint_sym_idx, jelf_ehdr_shnum, jelf_shdrtbl,
+            purpose, coin, args.bip32key, jelf_ident)
+
+    # Parse Output Filename
+    if args.output is None:
+        path_bn, ext = os.path.splitext(args.input_elf)
+        output_fn = path_bn + '.jelf'
+    else:
+        output_fn = args.output
+    assert(output_fn[-5:]=='.jelf')
+
+    ######################
+    # Generate Signature #
+    ######################
+    name_to_sign = os.path.basename(output_fn[:-5]).encode('utf-8')
+    jelf_contents, digest = stamp_variant(jelf_contents, jelf_ehdr_d,
+            name_to_sign)
+    signature = signing_engine.submit(args.key, digest).result()
+    signing_engine.close()
+
+    ###################################
+    # Write JELF binary and .gz files #
+    ###################################
+    write_variant(jelf_contents, jelf_ehdr_d, signature, output_fn)
 
     log.info("Complete!")
 
@@ -42,8 +42,11 @@ _Elf32_Shdr_d['sh_addralign'] = 'u32'
 _Elf32_Shdr_d['sh_entsize']   = 'u32'
 Elf32_Shdr = Unpacker( 'Elf32_Shdr', _Elf32_Shdr_d )
 
-Elf32_SHT_RELA   = 4
-Elf32_SHT_NOBITS = 8
+Elf32_SHT_PROGBITS = 1
+Elf32_SHT_RELA     = 4
+Elf32_SHT_NOBITS   = 8
+
+Elf32_SHN_LORESERVE = 0xFF00
 
 Elf32_SHF_ALLOC     = 1 << 1
 Elf32_SHF_EXECINSTR = 1 << 2
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+'''
+Packs multiple JELF files into a single bundle for provisioning.
+
+Bundle File Structure:
++--------------------------+
+| Jelf_Bundle_Hdr          |
++--------------------------+
+| Jelf_Bundle_Entry 0      |  sorted by name
+|   . . .                  |
+| Jelf_Bundle_Entry N-1    |
++--------------------------+
+| Shared Dictionary        |  b_dict_size bytes, may be empty
++--------------------------+
+| Compressed JELF 0        |
+|   . . .                  |
++--------------------------+
+
+Every JELF is deflated on its own (same parameters as the .jelf.gz files),
+but all of them are primed with a shared preset dictionary built from
+content that recurs across the apps. This gets most of the benefit of a
+single compression context while still letting one app be inflated by
+itself: look the name up in the index, then inflate be_zsize bytes at
+be_offset with the dictionary. JELF contents are stored unmodified, so each
+app's own signature still verifies after extraction.
+
+    python3 jelf_bundle.py pack -o apps.jbdl build/*.jelf
+    python3 jelf_bundle.py list apps.jbdl
+    python3 jelf_bundle.py extract apps.jbdl nano --verify
+'''
+
+import argparse
+import sys
+import bisect
+import zlib
+import logging
+from collections import defaultdict
+
+from elf2jelf import compress_data, COMPRESSION_W_BITS
+from jelf_reader import app_name, read_jelf_bytes, verify_contents
+from jelf_structs import Jelf_Bundle_Hdr, Jelf_Bundle_Entry
+
+log = logging.getLogger('jelf_bundle')
+
+BUNDLE_IDENT = '\x7fJBDL\x00'
+BUNDLE_VERSION_MAJOR = 0
+BUNDLE_VERSION_MINOR = 1
+
+# Name field is NUL-terminated
+MAX_NAME_LEN = int(Jelf_Bundle_Entry.d['be_name'][1:])//8 - 1
+
+# zlib can reach back at most a window less its minimum lookahead
+MAX_DICT_SIZE = 2**COMPRESSION_W_BITS - 262
+DICT_CHUNK = 32
+DICT_STEP = 4
+
+def build_shared_dict(apps, max_size=MAX_DICT_SIZE):
+    """
+    Builds a preset dictionary from byte runs shared by at least two apps.
+
+    A byte at offset p of an app can only reference the last
+    (MAX_DICT_SIZE - p) bytes of the dictionary, so only the start of each
+    app is searched, and runs are laid out in the order they occur in the
+    apps; a run that starts an app then sits a full dictionary length
+    behind it, which is still in reach.
+    """
+    if len(apps) < 2:
+        return b''
+    heads = [contents[:max_size] for contents in apps]
+
+    # Number of apps each chunk appears in
+    app_counts = defaultdict(int)
+    for head in heads:
+        chunks = set( head[i:i+DICT_CHUNK] for i in
+                range(0, len(head) - DICT_CHUNK + 1, DICT_STEP) )
+        for chunk in chunks:
+            app_counts[chunk] += 1
+
+    # Merge consecutive shared chunks into runs;
+    # run -> (number of apps sharing it, earliest offset)
+    runs = {}
+    def add_run(run, count, offset):
+        old_count, old_offset = runs.get(run, (0, offset))
+        runs[run] = (max(old_count, count), min(old_offset, offset))
+    for head in heads:
+        start = None
+        for i in range(0, len(head) - DICT_CHUNK + 1, DICT_STEP):
+            n = app_counts[head[i:i+DICT_CHUNK]]
+            if n >= 2:
+                if start is None:
+                    start, count = i, n
+                count = min(count, n)
+                end = i + DICT_CHUNK
+            elif start is not None:
+                add_run(head[start:end], count, start)
+                start = None
+        if start is not None:
+            add_run(head[start:end], count, start)
+
+    # Keep the most widely shared runs
+    ranked = sorted(runs.items(), key=lambda kv: (kv[1][0], len(kv[0])),
+            reverse=True)
+    selected = []
+    size = 0
+    for run, (count, offset) in ranked:
+        if size + DICT_CHUNK > max_size:
+            break
+        if any(run in s for _, s in selected):
+            continue
+        run = run[:max_size - size]
+        selected.append((offset, run))
+        size += len(run)
+    return b''.join(run for _, run in sorted(selected))
+
+def pack_bundle(jelfs):
+    """
+    jelfs: dict of app name to uncompressed JELF contents
+    returns: bundle bytes, shared dictionary size,
+            total size of the apps compressed separately (as .jelf.gz)
+    """
+    names = sorted(jelfs)
+    for name in names:
+        if len(name.encode('ascii')) > MAX_NAME_LEN:
+            raise ValueError("App name \"%s\" longer than %d characters" % \
+                    (name, MAX_NAME_LEN))
+
+    standalone = [compress_data(jelfs[name]) for name in names]
+    separate_size = sum(map(len, standalone))
+    zdict = build_shared_dict([jelfs[name] for name in names])
+    compressed = standalone
+    if zdict:
+        # Only keep the dictionary if it actually pays for itself
+        primed = [compress_data(jelfs[name], zdict) for name in names]
+        if separate_size <= sum(map(len, primed)) + len(zdict):
+            log.info("Shared dictionary didn't help; not using it")
+            zdict = b''
+        else:
+            compressed = primed
+
+    dict_offset = Jelf_Bundle_Hdr.size_bytes() \
+            + len(names) * Jelf_Bundle_Entry.size_bytes()
+    bundle = bytearray(Jelf_Bundle_Hdr.pack(BUNDLE_IDENT,
+            BUNDLE_VERSION_MAJOR, BUNDLE_VERSION_MINOR,
+            len(names), dict_offset, len(zdict)))
+    offset = dict_offset + len(zdict)
+    for name, zdata in zip(names, compressed):
+        bundle += Jelf_Bundle_Entry.pack(name, offset, len(zdata),
+                len(jelfs[name]))
+        offset += len(zdata)
+    bundle += zdict
+    for zdata in compressed:
+        bundle += zdata
+    return bytes(bundle), len(zdict), separate_size
+
+class JelfBundle:
+    """
+    Reads a bundle's index; apps are only inflated when extracted
+    """
+    def __init__(self, f):
+        self._f = f
+        self.hdr = Jelf_Bundle_Hdr.unpack(
+                self._read(0, Jelf_Bundle_Hdr.size_bytes()))
+        if self.hdr.b_ident != BUNDLE_IDENT:
+            raise ValueError("Not a JELF bundle")
+        entry_size = Jelf_Bundle_Entry.size_bytes()
+        index = self._read(Jelf_Bundle_Hdr.size_bytes(),
+                self.hdr.b_nentries * entry_size)
+        self.entries = [Jelf_Bundle_Entry.unpack(index[i:i+entry_size])
+                for i in range(0, len(index), entry_size)]
+        self.names = [entry.be_name.rstrip('\0') for entry in self.entries]
+        self._zdict = None
+
+    @classmethod
+    def open(cls, path):
+        return cls(open(path, 'rb'))
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _read(self, offset, size):
+        self._f.seek(offset)
+        data = self._f.read(size)
+        if len(data) != size:
+            raise ValueError("Truncated JELF bundle")
+        return data
+
+    def entry(self, name):
+        # Index is sorted by name
+        i = bisect.bisect_left(self.names, name)
+        if i == len(self.names) or self.names[i] != name:
+            raise KeyError("App \"%s\" not in bundle" % name)
+        return self.entries[i]
+
+    def extract(self, name):
+        """
+        Returns the uncompressed JELF contents of a single app
+        """
+        entry = self.entry(name)
+        if self._zdict is None:
+            self._zdict = self._read(self.hdr.b_dict_offset,
+                    self.hdr.b_dict_size)
+        kwargs = {'zdict': self._zdict} if self._zdict else {}
+        decompressor = zlib.decompressobj(wbits=COMPRESSION_W_BITS, **kwargs)
+        contents = decompressor.decompress(
+                self._read(entry.be_offset, entry.be_zsize))
+        contents += decompressor.flush()
+        if len(contents) != entry.be_size:
+            raise ValueError("Corrupt bundle entry \"%s\"" % name)
+        return contents
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+            description='Pack JELF files into a bundle, or extract from one')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    pack = subparsers.add_parser('pack', help='Create a bundle')
+    pack.add_argument('jelfs', type=str, nargs='+',
+            help='.jelf or .jelf.gz files to bundle')
+    pack.add_argument('--output', '-o', type=str, required=True,
+            help='Output bundle filename')
+
+    list_ = subparsers.add_parser('list', help='List apps in a bundle')
+    list_.add_argument('bundle', type=str)
+
+    extract = subparsers.add_parser('extract',
+            help='Extract a single app from a bundle')
+    extract.add_argument('bundle', type=str)
+    extract.add_argument('name', type=str, help='App name')
+    extract.add_argument('--output', '-o', type=str, default=None,
+            help='Output filename. Defaults to <name>.jelf')
+    extract.add_argument('--verify', action='store_true',
+            help='Check the extracted app\'s signature')
+    args = parser.parse_args()
+    return args
+
+def main():
+    args = parse_args()
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    logging.getLogger('elf2jelf').setLevel(logging.WARNING)
+
+    if args.command == 'pack':
+        jelfs = {}
+        for path in args.jelfs:
+            name = app_name(path)
+            if name in jelfs:
+                raise ValueError("App \"%s\" given more than once" % name)
+            jelfs[name] = read_jelf_bytes(path)
+        bundle, dict_size, separate = pack_bundle(jelfs)
+        with open(args.output, 'wb') as f:
+            f.write(bundle)
+        log.info("Bundled %d apps (%d bytes uncompressed) into %d bytes "
+                "with a %d byte shared dictionary; %d bytes as separate "
+                ".jelf.gz files" % (len(jelfs), sum(map(len, jelfs.values())),
+                    len(bundle), dict_size, separate))
+    elif args.command == 'list':
+        with JelfBundle.open(args.bundle) as bundle:
+            log.info("Shared dictionary: %d bytes" % bundle.hdr.b_dict_size)
+            for name, entry in zip(bundle.names, bundle.entries):
+                log.info("%-32s offset 0x%08X  %7d -> %7d bytes" % \
+                        (name, entry.be_offset, entry.be_size,
+                            entry.be_zsize))
+    elif args.command == 'extract':
+        with JelfBundle.open(args.bundle) as bundle:
+            contents = bundle.extract(args.name)
+        if args.verify:
+            verify_contents(args.name, contents)
+            log.info("Signature OK")
+        output_fn = args.output
+        if output_fn is None:
+            output_fn = args.name + '.jelf'
+        with open(output_fn, 'wb') as f:
+            f.write(contents)
+        log.info("Extracted %s (%d bytes)" % (output_fn, len(contents)))
+    return 0
+
+if __name__=='__main__':
+    sys.exit(main())
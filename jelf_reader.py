@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+'''
+Reads JELF files and verifies their signatures in bulk.
+
+JelfFile is lazy: opening a file only reads the JELF Header and the
+Section Header Table; section payloads are read on request.
+
+Bulk verification recomputes the ed25519ph signature over the application
+name followed by the file with e_signature zeroed, exactly as elf2jelf.py
+signs it. Both .jelf and .jelf.gz files are accepted.
+
+    python3 jelf_reader.py build/ --public_key <hex>
+'''
+
+import argparse
+import os, sys
+import io
+import time
+import zlib
+import logging
+from binascii import hexlify, unhexlify
+from multiprocessing import Pool
+
+from nacl.exceptions import BadSignatureError
+from nacl.bindings import \
+        crypto_sign_ed25519ph_state, \
+        crypto_sign_ed25519ph_update, \
+        crypto_sign_ed25519ph_final_verify
+
+from jelf_structs import \
+        Jelf_Ehdr, Jelf_Shdr, Jelf_Sym, Jelf_Rela, Jelf_Import, \
+        JELF_IDENT, JELF_IDENT_IMPORTS, Jelf_SHT_RELA, Jelf_SHT_SYMTAB
+
+log = logging.getLogger('jelf_reader')
+
+JELF_IDENTS = (JELF_IDENT, JELF_IDENT_IMPORTS)
+JELF_EXTENSIONS = ('.jelf', '.jelf.gz')
+
+def field_offset(unpacker, field):
+    """
+    Byte offset and byte length of a byte-aligned field of an Unpacker
+    """
+    bits = 0
+    for k, v in unpacker.d.items():
+        n_bits = int(v[1:])
+        if k == field:
+            assert(bits % 8 == 0 and n_bits % 8 == 0)
+            return bits // 8, n_bits // 8
+        bits += n_bits
+    raise KeyError(field)
+
+E_SIGNATURE_OFFSET, E_SIGNATURE_SIZE = field_offset(Jelf_Ehdr, 'e_signature')
+
+def app_name(path):
+    """
+    The application name that gets signed; the filename without extension
+    """
+    base = os.path.basename(path)
+    for ext in JELF_EXTENSIONS[::-1]:
+        if base.endswith(ext):
+            return base[:-len(ext)]
+    raise ValueError("%s is not a JELF file" % path)
+
+def read_jelf_bytes(path):
+    """
+    Returns the uncompressed contents of a .jelf or .jelf.gz file
+    """
+    with open(path, 'rb') as f:
+        contents = f.read()
+    if path.endswith('.gz'):
+        contents = zlib.decompress(contents)
+    return contents
+
+class JelfFile:
+    """
+    Lazily parsed JELF file backed by a seekable binary file object
+    """
+    def __init__(self, f):
+        self._f = f
+        self.ehdr = Jelf_Ehdr.unpack(self._read(0, Jelf_Ehdr.size_bytes()))
+        if self.ehdr.e_ident not in JELF_IDENTS:
+            raise ValueError("Not a JELF file")
+        shdr_size = Jelf_Shdr.size_bytes()
+        table = self._read(self.ehdr.e_shoff, self.ehdr.e_shnum * shdr_size)
+        self.shdrs = [Jelf_Shdr.unpack(table[i:i+shdr_size])
+                for i in range(0, len(table), shdr_size)]
+
+    @classmethod
+    def open(cls, path):
+        """
+        Opens a .jelf or .jelf.gz file. Compressed files are inflated into
+        memory since zlib streams aren't seekable.
+        """
+        if path.endswith('.gz'):
+            return cls(io.BytesIO(read_jelf_bytes(path)))
+        f = open(path, 'rb')
+        try:
+            return cls(f)
+        except Exception:
+            f.close()
+            raise
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _read(self, offset, size):
+        self._f.seek(offset)
+        data = self._f.read(size)
+        if len(data) != size:
+            raise ValueError("Truncated JELF file")
+        return data
+
+    def section_data(self, index):
+        """
+        Reads the payload of a section
+        """
+        shdr = self.shdrs[index]
+        return self._read(shdr.sh_offset, shdr.sh_size)
+
+    def symtab_index(self):
+        for i, shdr in enumerate(self.shdrs):
+            if shdr.sh_type == Jelf_SHT_SYMTAB:
+                return i
+        raise ValueError("JELF file has no symtab")
+
+    def symbols(self):
+        """
+        Returns a list of Jelf_Sym
+        """
+        symtab = self.section_data(self.symtab_index())
+        sym_size = Jelf_Sym.size_bytes()
+        return [Jelf_Sym.unpack(symtab[i:i+sym_size])
+                for i in range(0, len(symtab), sym_size)]
+
+    def imports(self):
+        """
+        Returns the import table as a list of 1-indexed export list indices,
+        or None if symbol names index the export list directly
+        """
+        if self.ehdr.e_ident != JELF_IDENT_IMPORTS:
+            return None
+        symtab_shdr = self.shdrs[self.symtab_index()]
+        table = self.section_data(symtab_shdr.sh_info)
+        import_size = Jelf_Import.size_bytes()
+        return [Jelf_Import.unpack(table[i:i+import_size]).i_name
+                for i in range(0, len(table), import_size)]
+
+    def relas(self, index):
+        """
+        Returns a list of Jelf_Rela for a RELA section
+        """
+        assert(self.shdrs[index].sh_type == Jelf_SHT_RELA)
+        relas = self.section_data(index)
+        rela_size = Jelf_Rela.size_bytes()
+        return [Jelf_Rela.unpack(relas[i:i+rela_size])
+                for i in range(0, len(relas), rela_size)]
+
+def verify_contents(name, contents, public_key=None):
+    """
+    Checks the signature of uncompressed JELF contents.
+    Raises BadSignatureError on mismatch.
+    """
+    ehdr = Jelf_Ehdr.unpack(contents[:Jelf_Ehdr.size_bytes()])
+    if ehdr.e_ident not in JELF_IDENTS:
+        raise ValueError("Not a JELF file")
+    if public_key is not None and ehdr.e_public_key != public_key:
+        raise BadSignatureError("Signed by untrusted key %s" % \
+                hexlify(ehdr.e_public_key).decode('ascii'))
+    unsigned = bytearray(contents)
+    unsigned[E_SIGNATURE_OFFSET:E_SIGNATURE_OFFSET+E_SIGNATURE_SIZE] = \
+            bytes(E_SIGNATURE_SIZE)
+    state = crypto_sign_ed25519ph_state()
+    crypto_sign_ed25519ph_update(state, name.encode('utf-8'))
+    crypto_sign_ed25519ph_update(state, bytes(unsigned))
+    crypto_sign_ed25519ph_final_verify(state, ehdr.e_signature,
+            ehdr.e_public_key)
+
+def verify_jelf(path, public_key=None):
+    """
+    Returns (path, number of uncompressed bytes, error string or None).
+    The byte count covers whatever was read, even if verification failed.
+    """
+    contents = b''
+    try:
+        contents = read_jelf_bytes(path)
+        verify_contents(app_name(path), contents, public_key)
+        return path, len(contents), None
+    except Exception as e:
+        return path, len(contents), "%s: %s" % (type(e).__name__, e)
+
+def _verify_jelf_star(task):
+    return verify_jelf(*task)
+
+def find_jelfs(paths):
+    """
+    Expands directories into the JELF files they contain
+    """
+    jelfs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                jelfs.extend(os.path.join(root, fn) for fn in sorted(files)
+                        if fn.endswith(JELF_EXTENSIONS))
+        else:
+            jelfs.append(path)
+    return jelfs
+
+def verify_all(paths, public_key=None, processes=None):
+    """
+    Verifies many JELF files across a process pool.
+    Returns (list of (path, error) mismatches, bytes verified, seconds)
+    """
+    if processes is None:
+        processes = os.cpu_count() or 1
+    tasks = [(path, public_key) for path in paths]
+    chunksize = max(1, len(tasks) // (8 * processes))
+    start = time.perf_counter()
+    with Pool(processes) as pool:
+        results = list(pool.imap_unordered(_verify_jelf_star, tasks,
+                chunksize=chunksize))
+    elapsed = time.perf_counter() - start
+    mismatches = sorted((path, err) for path, _, err in results if err)
+    n_bytes = sum(n for _, n, _ in results)
+    return mismatches, n_bytes, elapsed
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+            description='Verify signatures of JELF files in bulk')
+    parser.add_argument('paths', type=str, nargs='+',
+            help='JELF files or directories to search for .jelf/.jelf.gz')
+    parser.add_argument('--public_key', type=str, default=None,
+            help='''
+            Trusted 256-bit public key in hexidecimal. If omitted, files are
+            only checked against the public key in their own header.''')
+    parser.add_argument('--processes', '-j', type=int, default=None,
+            help='Number of worker processes. Defaults to the CPU count.')
+    args = parser.parse_args()
+    return args
+
+def main():
+    args = parse_args()
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    public_key = None
+    if args.public_key is not None:
+        public_key = unhexlify(args.public_key)
+        assert(len(public_key)==32)
+
+    paths = find_jelfs(args.paths)
+    log.info("Verifying %d JELF files" % len(paths))
+    mismatches, n_bytes, elapsed = verify_all(paths, public_key,
+            args.processes)
+
+    for path, err in mismatches:
+        log.error("MISMATCH %s (%s)" % (path, err))
+    elapsed = max(elapsed, 1e-9)
+    log.info("Verified %d files (%d bytes) in %.3fs: %.1f files/s, %.2f MB/s" % \
+            (len(paths), n_bytes, elapsed, len(paths)/elapsed,
+                n_bytes/elapsed/1e6))
+    log.info("%d mismatches" % len(mismatches))
+    return 1 if mismatches else 0
+
+if __name__=='__main__':
+    sys.exit(main())
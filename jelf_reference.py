@@ -0,0 +1,442 @@
+'''
+Frozen reference implementation of the ELF32 to JELF conversion pipeline.
+
+These are verbatim copies of the pure-Python stages of elf2jelf.py (and the
+Unpacker from common_structs.py) as of the introduction of the regression
+harness. Do not optimize or otherwise modify this file; jelf_regress.py
+checks that any fast path in elf2jelf.py produces byte-identical output to
+this code and compares their throughput.
+'''
+
+import math
+import logging
+from collections import OrderedDict, namedtuple
+import bitstruct as bs
+from nacl.bindings import \
+        crypto_sign_ed25519ph_state, \
+        crypto_sign_ed25519ph_update, \
+        crypto_sign_ed25519ph_final_create
+
+from elf32_structs import \
+        _Elf32_Ehdr_d, _Elf32_Shdr_d, _Elf32_Sym_d, _Elf32_Rela_d, \
+        Elf32_SHT_RELA, Elf32_SHT_NOBITS, \
+        Elf32_SHF_ALLOC, Elf32_SHF_EXECINSTR, \
+        Elf32_R_XTENSA_NONE, Elf32_R_XTENSA_32, \
+        Elf32_R_XTENSA_ASM_EXPAND, Elf32_R_XTENSA_SLOT0_OP
+from jelf_structs import \
+        _Jelf_Ehdr_d, _Jelf_Shdr_d, _Jelf_Sym_d, _Jelf_Rela_d, \
+        Jelf_SHT_OTHER, Jelf_SHT_RELA, Jelf_SHT_NOBITS, Jelf_SHT_SYMTAB, \
+        Jelf_SHF_ALLOC, Jelf_SHF_EXECINSTR, \
+        Jelf_R_XTENSA_NONE, Jelf_R_XTENSA_32, \
+        Jelf_R_XTENSA_ASM_EXPAND, Jelf_R_XTENSA_SLOT0_OP
+
+log = logging.getLogger('jelf_reference')
+
+'''
+Index into a string table
+'''
+def index_strtab(s, index):
+    null_terminator = s.find(0, index)
+    return s[index:null_terminator]
+
+'''
+Convenience class to unpack data into a namedtuple
+'''
+class Unpacker:
+    def __init__(self, name:str, d: OrderedDict):
+        self.d = d
+        self.fstr = self._parse_format_str( d )
+        self.compiled_fstr = bs.compile(self.fstr)
+        self.name = name
+        self.names = namedtuple( name, d.keys() )
+
+    def _parse_format_str(self, d :OrderedDict):
+        '''
+        Concatenates all string values of an OrderedDict
+        '''
+        fstr = ''.join(d.values())
+        fstr += '<' # Least Significant Byte First
+        return fstr
+
+    def pack(self, *datas):
+        # Reverse text and raw bytes
+        datas = list(datas)
+        for i, (k, v) in enumerate(self.d.items()):
+            if v[0] == 't' or v[0] == 'r':
+                if v[0] == 'r':
+                    b = bytearray(int(v[1:])//8)
+                    b[:len(datas[i])] = datas[i]
+                else:
+                    len_diff = (int(v[1:])//8) - len(datas[i])
+                    b = datas[i] + '\0'*len_diff
+                datas[i] = b[::-1]
+        return self.compiled_fstr.pack(*tuple(datas))
+
+    def unpack(self, data):
+        '''
+        Returns a named tuple of unpacking provided data
+        '''
+        unpacked = self.compiled_fstr.unpack(data)
+        tup = self.names(*unpacked)
+
+        # Have to reverse for the t and r types since they should be observed
+        # as independent streams of bytes
+        d = tup._asdict()
+        for k, v in self.d.items():
+            if v[0] == 't' or v[0] == 'r':
+                d[k] = d[k][::-1]
+        return self.names(**d)
+
+    def size_bits(self):
+        return self.compiled_fstr.calcsize()
+
+    def size_bytes(self):
+        return int(math.ceil(self.size_bits() / 8))
+
+Elf32_Ehdr = Unpacker( 'Elf32_Ehdr', _Elf32_Ehdr_d )
+Elf32_Shdr = Unpacker( 'Elf32_Shdr', _Elf32_Shdr_d )
+Elf32_Sym  = Unpacker( 'Elf32_Sym',  _Elf32_Sym_d )
+Elf32_Rela = Unpacker( 'Elf32_Rela', _Elf32_Rela_d )
+Jelf_Ehdr  = Unpacker( 'Jelf_Ehdr',  _Jelf_Ehdr_d )
+Jelf_Shdr  = Unpacker( 'Jelf_Shdr',  _Jelf_Shdr_d )
+Jelf_Sym   = Unpacker( 'Jelf_Sym',   _Jelf_Sym_d )
+Jelf_Rela  = Unpacker( 'Jelf_Rela',  _Jelf_Rela_d )
+
+def get_ehdr(elf_contents):
+    assert( Elf32_Ehdr.size_bytes() == 52 )
+    ehdr = Elf32_Ehdr.unpack(elf_contents[0:])
+    assert(ehdr.e_ident == \
+            '\x7fELF\x01\x01\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+    assert(ehdr.e_machine == 94)
+    return ehdr
+
+def get_shstrtab(elf_contents, ehdr):
+    """
+    Reads and returns the SectionHeaderStringTable
+    """
+    assert( Elf32_Shdr.size_bytes() == 40 )
+    offset = ehdr.e_shoff + ehdr.e_shstrndx * Elf32_Shdr.size_bytes()
+    shstrtab_shdr = Elf32_Shdr.unpack(elf_contents[offset:])
+    # Read the actual SectionHeaderTable
+    shstrtab = elf_contents[shstrtab_shdr.sh_offset:
+            shstrtab_shdr.sh_offset+shstrtab_shdr.sh_size]
+    shstrtab_name = index_strtab(shstrtab, shstrtab_shdr.sh_name)
+    assert( shstrtab_name == b'.shstrtab' )
+    return shstrtab
+
+def read_section_headers(elf_contents, ehdr, shstrtab):
+    """
+    Read all SectionHeaders, their names, and read in symtab, strtab
+    """
+    elf32_shdrs = []
+    elf32_shdr_names = []
+    elf32_symtab = None
+    elf32_strtab = None
+    # Iterate through the SectionHeader elements of the Table
+    for i in range(ehdr.e_shnum):
+        offset = ehdr.e_shoff + i * Elf32_Shdr.size_bytes()
+        elf32_shdr = Elf32_Shdr.unpack(elf_contents[offset:])
+
+        shdr_name = index_strtab(shstrtab, elf32_shdr.sh_name)
+        log.debug("Read in Section Header %d. %s " % (i, shdr_name))
+
+        if( shdr_name == b'.symtab' ):
+            elf32_symtab = elf_contents[ elf32_shdr.sh_offset:
+                    elf32_shdr.sh_offset+elf32_shdr.sh_size ]
+        elif( shdr_name == b'.strtab' ):
+            elf32_strtab = elf_contents[ elf32_shdr.sh_offset:
+                    elf32_shdr.sh_offset+elf32_shdr.sh_size ]
+        elf32_shdrs.append( elf32_shdr )
+        elf32_shdr_names.append(shdr_name)
+    return elf32_shdrs, elf32_shdr_names, elf32_symtab, elf32_strtab
+
+def convert_shdrs(elf32_shdrs):
+    """
+    Converts ALL ELF32 Section Headers to JELF Headers
+    """
+    jelf_shdrs = []
+    for elf32_shdr in elf32_shdrs:
+        jelf_shdr_d = OrderedDict()
+
+        # Convert the "sh_type" field
+        if elf32_shdr.sh_type == Elf32_SHT_RELA:
+            jelf_shdr_d['sh_type'] = Jelf_SHT_RELA
+        elif elf32_shdr.sh_type == Elf32_SHT_NOBITS:
+            jelf_shdr_d['sh_type'] = Jelf_SHT_NOBITS
+        else:
+            jelf_shdr_d['sh_type'] = Jelf_SHT_OTHER
+
+        # Convert the "sh_flag" field
+        jelf_shdr_d['sh_flags'] = 0
+        if elf32_shdr.sh_flags & Elf32_SHF_ALLOC:
+            jelf_shdr_d['sh_flags'] |= Jelf_SHF_ALLOC
+        if elf32_shdr.sh_flags & Elf32_SHF_EXECINSTR:
+            jelf_shdr_d['sh_flags'] |= Jelf_SHF_EXECINSTR
+
+        # This is a placeholder and will be updated later
+        jelf_shdr_d['sh_offset'] = None
+
+        if elf32_shdr.sh_size > 2**19:
+            raise("Overflow Detected")
+        # for symtab and relas, this will be updated later
+        # All other sections maintain the same size
+        jelf_shdr_d['sh_size'] = elf32_shdr.sh_size
+
+        if elf32_shdr.sh_info > 2**14:
+            raise("Overflow Detected")
+        jelf_shdr_d['sh_info'] = elf32_shdr.sh_info
+
+        log.debug(jelf_shdr_d)
+        jelf_shdrs.append(jelf_shdr_d)
+    return jelf_shdrs
+
+def convert_symtab(elf32_symtab, elf32_strtab, export_list):
+    elf32_sym_size = Elf32_Sym.size_bytes()
+    jelf_sym_size  = Jelf_Sym.size_bytes()
+
+    symtab_nent = int( len(elf32_symtab)/elf32_sym_size )
+    jelf_symtab = bytearray( symtab_nent * jelf_sym_size )
+
+    for i in range(symtab_nent):
+        begin = i * elf32_sym_size
+        end = begin + elf32_sym_size
+        elf32_symbol = Elf32_Sym.unpack( elf32_symtab[begin:end] )
+        del(begin, end)
+
+        # Lookup Symbol name in exported function list
+        sym_name = index_strtab(elf32_strtab, elf32_symbol.st_name).decode('ascii')
+
+        # Convert the SymbolName to a 1-indexed Exported Function
+        jelf_name_index = 0 # 0 means no name
+        if sym_name == '':
+            log.debug( "Symbol index %d has no name %d." % \
+                    (i, elf32_symbol.st_name) )
+        else:
+            try:
+                # Plus one because 0 means no name
+                jelf_name_index = export_list.index(sym_name) + 1
+                log.debug( ("Symbol index %d has name %s "
+                    "and matched to exported function index %d.") % \
+                        (i, sym_name, jelf_name_index) )
+            except ValueError:
+                # The function is internal to the app
+                # st_shndx is the thing that matters in this case
+                pass
+
+        # WARNING: st_shndx relies on all the sections being
+        # in the same order
+        if elf32_symbol.st_shndx > 2**16:
+            raise("Overflow Detected")
+        begin = i * jelf_sym_size
+        end = begin + jelf_sym_size
+        jelf_symtab[begin:end] = Jelf_Sym.pack(
+                jelf_name_index,
+                elf32_symbol.st_shndx,
+                elf32_symbol.st_value,
+                )
+        del(begin, end)
+        if sym_name == "app_main":
+            # todo this may not be the most correct
+            jelf_entrypoint_sym_idx = i
+    return jelf_symtab, jelf_entrypoint_sym_idx
+
+def convert_relas(elf_contents, elf32_shdrs, jelf_shdrs):
+    """
+    Returns dict jelf_relas where:
+        keys: index into jelf_shdrs.
+        values: bytearray of the complete converted rela section.
+    Populates jelf_shdrs[i]['sh_size'] to reflect the change in size of
+    each rela section.
+    returns: jelf_relas, jelf_shdrs
+    """
+    # Sanity Check
+    assert( len(jelf_shdrs) == len(elf32_shdrs) )
+
+    jelf_relas = {}
+    for i in range(len(jelf_shdrs)):
+        # only iterate over the RELA sections
+        if jelf_shdrs[i]['sh_type'] != Jelf_SHT_RELA:
+            continue
+
+        # Get number of relocations in this section
+        n_relas = int(elf32_shdrs[i].sh_size / Elf32_Rela.size_bytes())
+        # 'sh_size' is currently as if we were using ELF32_SYM
+        jelf_shdrs[i]['sh_size'] = n_relas * Jelf_Rela.size_bytes()
+        jelf_sec_relas = bytearray( jelf_shdrs[i]['sh_size'] )
+
+        for j in range(n_relas):
+            # pointer into the binaries
+            elf32_offset = elf32_shdrs[i].sh_offset \
+                    + j * Elf32_Rela.size_bytes()
+            # offset into the newly allocated jelf section
+            jelf_offset  = j * Jelf_Rela.size_bytes()
+
+            rela = Elf32_Rela.unpack(elf_contents[elf32_offset:])
+
+            elf32_r_type = rela.r_info & 0xFF
+
+            # Convert r_info; 2 bit left shift for jelf_r_type
+            jelf_r_info = ((rela.r_info & ~0xFF) >> 8) << 2
+            if rela.r_offset > 2**16:
+                raise("Overflow Detected")
+            if jelf_r_info > 2**16:
+                raise("Overflow Detected")
+            if rela.r_addend > 2**15 or rela.r_addend < -2**15:
+                raise("Overflow Detected")
+
+            # Convert the type and store in bottom 2 bits of r_info
+            if elf32_r_type == Elf32_R_XTENSA_NONE:
+                jelf_r_info |= Jelf_R_XTENSA_NONE
+            elif elf32_r_type == Elf32_R_XTENSA_32:
+                jelf_r_info |= Jelf_R_XTENSA_32
+            elif elf32_r_type == Elf32_R_XTENSA_ASM_EXPAND:
+                jelf_r_info |= Jelf_R_XTENSA_ASM_EXPAND
+            elif elf32_r_type == Elf32_R_XTENSA_SLOT0_OP:
+                jelf_r_info |= Jelf_R_XTENSA_SLOT0_OP
+            else:
+                log.error("Failed on %d %s" % (i, elf32_shdr_names[i]))
+                raise("Unexpected RELA Type")
+
+            # Pack the data into the rela section's bytearray
+            jelf_sec_relas[jelf_offset:jelf_offset+Jelf_Rela.size_bytes()] = \
+                    Jelf_Rela.pack(rela.r_offset, jelf_r_info, rela.r_addend)
+        jelf_relas[i] = jelf_sec_relas
+    return jelf_relas, jelf_shdrs
+
+def write_jelf_sections(elf_contents,
+        elf32_shdrs, elf32_shdr_names,
+        jelf_shdrs, jelf_relas, jelf_symtab):
+    """
+    Writes all sections to binary
+    """
+    # Sanity Check
+    assert( len(jelf_shdrs) == len(elf32_shdrs) )
+    assert( len(elf32_shdrs) == len(elf32_shdr_names) )
+
+    # over allocate for now
+    jelf_contents = bytearray(len(elf_contents))
+    jelf_ptr = Jelf_Ehdr.size_bytes() # Skip the JELF Header
+
+    # Note: the st_shndx of Jelf_Sym indexes into sectionheadertable elements.
+    # does this get messed up when stripping strtab and shstrtab?
+    for i, name in enumerate(elf32_shdr_names):
+        jelf_shdrs[i]['sh_offset'] = jelf_ptr
+        if name == b'.symtab':
+            # Copy over our updated Jelf symtab
+            jelf_shdrs[i]['sh_size'] = len(jelf_symtab)
+            jelf_shdrs[i]['sh_type'] = Jelf_SHT_SYMTAB # custom
+            new_jelf_ptr = jelf_ptr + jelf_shdrs[i]['sh_size']
+            jelf_contents[jelf_ptr:new_jelf_ptr] = jelf_symtab
+        elif name == b'.strtab' or name == b'.shstrtab':
+            # Dont copy over since we're stripping it
+            # We'll filter this out later
+            jelf_shdrs[i] = None
+            continue
+        elif jelf_shdrs[i]['sh_type'] == Jelf_SHT_RELA:
+            new_jelf_ptr = jelf_ptr + jelf_shdrs[i]['sh_size']
+            jelf_contents[jelf_ptr:new_jelf_ptr] = jelf_relas[i]
+        else:
+            new_jelf_ptr = jelf_ptr + jelf_shdrs[i]['sh_size']
+            assert(jelf_shdrs[i]['sh_size']==elf32_shdrs[i].sh_size)
+            jelf_contents[jelf_ptr:new_jelf_ptr] = \
+                    elf_contents[
+                            elf32_shdrs[i].sh_offset :
+                            elf32_shdrs[i].sh_offset+jelf_shdrs[i]['sh_size']
+                            ]
+        if jelf_shdrs[i]['sh_offset'] > 2**19:
+            raise("Overflow Detected")
+        jelf_ptr = new_jelf_ptr
+    return jelf_contents, jelf_ptr, jelf_shdrs
+
+def write_jelf_sectionheadertable(jelf_contents,
+        jelf_shdrs, jelf_ptr):
+    """
+    Writes the SectionHeaderTable to jelf_contents at jelf_ptr
+    """
+    log.debug("SectionHeaderTable Offset: 0x%08X" % jelf_ptr)
+    section_count = 0
+    for i, jelf_shdr in enumerate(jelf_shdrs):
+        if jelf_shdrs[i] is None:
+            continue
+        section_count += 1
+
+        new_jelf_ptr = jelf_ptr + Jelf_Shdr.size_bytes()
+        shdr_bytes = Jelf_Shdr.pack( *(jelf_shdr.values()) )
+        log.debug(jelf_shdr)
+        jelf_contents[jelf_ptr:new_jelf_ptr] = shdr_bytes
+        jelf_ptr = new_jelf_ptr
+    # trim jelf_contents to final length
+    jelf_contents = jelf_contents[:jelf_ptr]
+    return jelf_contents, section_count
+
+def convert_elf(elf_contents, export_list):
+    """
+    Converts the contents of an ELF32 file to JELF. The JELF Header is left
+    blank; the caller fills it in and signs.
+    returns: jelf_contents, jelf_entrypoint_sym_idx, jelf_ehdr_shnum,
+            jelf_shdrtbl
+    """
+    #####################
+    # Unpack ELF Header #
+    #####################
+    ehdr = get_ehdr(elf_contents)
+
+    ##########################################
+    # Read SectionHeaderTable Section Header #
+    ##########################################
+    shstrtab = get_shstrtab(elf_contents, ehdr)
+
+    ###########################
+    # Process Section Headers #
+    ###########################
+    elf32_shdrs, elf32_shdr_names, elf32_symtab, elf32_strtab = \
+            read_section_headers( elf_contents, ehdr, shstrtab )
+    jelf_shdrs = convert_shdrs( elf32_shdrs )
+
+    ###########################################
+    # Convert the ELF32 symtab to JELF Format #
+    ###########################################
+    jelf_symtab, jelf_entrypoint_sym_idx = convert_symtab(elf32_symtab,
+            elf32_strtab, export_list)
+
+    #########################################
+    # Convert the ELF32 RELA to JELF Format #
+    #########################################
+    jelf_relas, jelf_shdrs = convert_relas(elf_contents,
+            elf32_shdrs, jelf_shdrs)
+
+    #######################
+    # Write JELF Sections #
+    #######################
+    jelf_contents, jelf_ptr, jelf_shdrs = write_jelf_sections(elf_contents,
+            elf32_shdrs, elf32_shdr_names,
+            jelf_shdrs, jelf_relas, jelf_symtab)
+
+    ##################################################
+    # Write Section Header Table to end of JELF File #
+    ##################################################
+    jelf_shdrtbl = jelf_ptr
+    jelf_contents, jelf_ehdr_shnum = write_jelf_sectionheadertable(jelf_contents,
+            jelf_shdrs, jelf_ptr)
+
+    return jelf_contents, jelf_entrypoint_sym_idx, jelf_ehdr_shnum, \
+            jelf_shdrtbl
+
+def sign_jelf(jelf_contents, jelf_ehdr_d, name_to_sign, sk, pk):
+    """
+    Packs the JELF Header and signs in place, as main() originally did.
+    returns: signature
+    """
+    jelf_contents[:Jelf_Ehdr.size_bytes()] = Jelf_Ehdr.pack(
+            *jelf_ehdr_d.values() )
+
+    state = crypto_sign_ed25519ph_state()
+    crypto_sign_ed25519ph_update(state, name_to_sign)
+    crypto_sign_ed25519ph_update(state, bytes(jelf_contents))
+    signature = crypto_sign_ed25519ph_final_create(state, sk+pk)
+
+    # Rewrite the header
+    jelf_ehdr_d['e_signature'] = signature
+    jelf_contents[:Jelf_Ehdr.size_bytes()] = Jelf_Ehdr.pack(
+            *jelf_ehdr_d.values() )
+    return signature
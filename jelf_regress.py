@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+
+'''
+Golden-corpus equivalence and throughput regression gate.
+
+Every ELF in the corpus is converted twice: once by the current pipeline in
+elf2jelf.py and once by the frozen reference pipeline in jelf_reference.py.
+The output of every stage, and the final signed JELF, must be byte-identical.
+Every relocation and symbol must also resolve to the same bytes before and
+after merge_sections().
+
+Each stage's speedup over the reference implementation, timed on the same
+machine in the same run, is compared against a stored baseline; the gate
+fails if any stage's speedup drops by more than --threshold, or if there is
+no baseline. Absolute throughput (MB of input ELF per second) depends on
+the machine, so it is only reported.
+
+The corpus is every *.elf file in --corpus plus --synthetic generated ELFs
+that mimic an esp-idf -ffunction-sections build.
+
+    python3 jelf_regress.py --corpus apps/ --update_baseline
+    python3 jelf_regress.py --corpus apps/
+'''
+
+import argparse
+import os, sys
+import json
+import time
+import gc
+import random
+import statistics
+import struct
+import logging
+from collections import OrderedDict
+from copy import deepcopy
+
+import elf2jelf
+import jelf_reference
+from signing import Keystore
+
+log = logging.getLogger('jelf_regress')
+
+this_path = os.path.dirname(os.path.realpath(__file__))
+
+STAGES = ('read_section_headers', 'convert_shdrs', 'convert_symtab',
+        'convert_relas', 'write_jelf_sections',
+        'write_jelf_sectionheadertable', 'Unpacker')
+
+# Stages faster than this are called repeatedly, timeit-style, until this
+# much time has been spent so their timings clear the timer noise
+MIN_TIMED_SECONDS = 0.01
+
+# Fixed development key so that signatures are reproducible
+REGRESS_SEED = bytes(range(32))
+
+def synthetic_elf(n_functions, seed=0, export_list=(), leaf_ratio=0.25):
+    """
+    Generates a relocatable Xtensa ELF32 laid out like an esp-idf
+    -ffunction-sections build: .literal/.text fragments per function, a
+    .rela.text fragment for non-leaf functions, .rodata fragments, .data,
+    .bss, .symtab, .strtab, .shstrtab.
+    """
+    rnd = random.Random(seed)
+    def random_bytes(n):
+        return bytes(rnd.getrandbits(8) for _ in range(n))
+
+    # (name, sh_type, sh_flags, data, sh_link, sh_info, sh_addralign, sh_entsize)
+    sections = [(b'', 0, 0, b'', 0, 0, 0, 0)]
+    strtab = bytearray(b'\x00')
+    def add_str(s):
+        offset = len(strtab)
+        strtab.extend(s + b'\x00')
+        return offset
+    # (st_name, st_value, st_size, st_info, st_other, st_shndx)
+    syms = [(0, 0, 0, 0, 0, 0)]
+    STT_SECTION, STB_GLOBAL_FUNC, STB_GLOBAL_NOTYPE = 0x03, 0x12, 0x10
+    SHF_WA, SHF_A, SHF_AX = 0x3, 0x2, 0x6
+
+    text_shndxs = []
+    for i in range(n_functions):
+        literal_size = rnd.randrange(0, 10) * 4
+        if literal_size:
+            sections.append((b'.literal.f%d' % i, 1, SHF_AX,
+                    random_bytes(literal_size), 0, 0, 4, 0))
+            syms.append((0, 0, 0, STT_SECTION, 0, len(sections)-1))
+        sections.append((b'.text.f%d' % i, 1, SHF_AX,
+                random_bytes(rnd.randrange(1, 64) * 4), 0, 0, 4, 0))
+        syms.append((0, 0, 0, STT_SECTION, 0, len(sections)-1))
+        text_shndxs.append(len(sections)-1)
+    for i in range(n_functions // 2):
+        sections.append((b'.rodata.r%d' % i, 1, SHF_A,
+                random_bytes(rnd.randrange(1, 64)), 0, 0, 4, 0))
+        syms.append((0, 0, 0, STT_SECTION, 0, len(sections)-1))
+    sections.append((b'.data', 1, SHF_WA, random_bytes(16), 0, 0, 4, 0))
+    syms.append((0, 0, 0, STT_SECTION, 0, len(sections)-1))
+    bss_shndx = len(sections)
+    sections.append((b'.bss', 8, SHF_WA, b'', 0, 0, 4, 0))
+    syms.append((0, 0, 0, STT_SECTION, 0, bss_shndx))
+
+    for i, shndx in enumerate(text_shndxs):
+        name = b'app_main' if i == 0 else b'app_func_%d' % i
+        syms.append((add_str(name), 0, len(sections[shndx][3]),
+                STB_GLOBAL_FUNC, 0, shndx))
+    imports = list(export_list)[:max(1, n_functions // 2)]
+    for name in imports:
+        syms.append((add_str(name.encode('ascii')), 0, 0,
+                STB_GLOBAL_NOTYPE, 0, 0))
+
+    # Leaf functions get no .rela section; the last function never is one,
+    # so leaf_ratio=1 leaves a single .rela fragment at the end of .text
+    rela_shndxs = [shndx for shndx in text_shndxs
+            if rnd.random() >= leaf_ratio or shndx == text_shndxs[-1]]
+    symtab_shndx = len(sections) + len(rela_shndxs)
+    r_types = (elf2jelf.Elf32_R_XTENSA_NONE, elf2jelf.Elf32_R_XTENSA_32,
+            elf2jelf.Elf32_R_XTENSA_ASM_EXPAND, elf2jelf.Elf32_R_XTENSA_SLOT0_OP)
+    for shndx in rela_shndxs:
+        text_size = len(sections[shndx][3])
+        relas = b''.join( struct.pack('<IIi',
+                rnd.randrange(0, text_size),
+                (rnd.randrange(1, len(syms)) << 8) | rnd.choice(r_types),
+                rnd.randrange(-1024, 1024))
+                for _ in range(rnd.randrange(0, 16)) )
+        sections.append((b'.rela' + sections[shndx][0], 4, 0x40, relas,
+                symtab_shndx, shndx, 4, 12))
+
+    assert(len(sections) == symtab_shndx)
+    symtab = b''.join(struct.pack('<IIIBBH', *sym) for sym in syms)
+    sections.append((b'.symtab', 2, 0, symtab, symtab_shndx+1,
+            n_functions+1, 4, 16))
+    sections.append((b'.strtab', 3, 0, bytes(strtab), 0, 0, 1, 0))
+    shstrtab = bytearray(b'\x00')
+    sh_names = []
+    for name in [s[0] for s in sections] + [b'.shstrtab']:
+        sh_names.append(len(shstrtab) if name else 0)
+        if name:
+            shstrtab.extend(name + b'\x00')
+    sections.append((b'.shstrtab', 3, 0, bytes(shstrtab), 0, 0, 1, 0))
+
+    elf = bytearray(52)
+    sh_offsets = []
+    for section in sections:
+        elf.extend(bytes(elf2jelf.align(len(elf)) - len(elf)))
+        sh_offsets.append(len(elf))
+        elf.extend(section[3])
+    elf.extend(bytes(elf2jelf.align(len(elf)) - len(elf)))
+    e_shoff = len(elf)
+    for i, (name, sh_type, sh_flags, data, sh_link, sh_info,
+            sh_addralign, sh_entsize) in enumerate(sections):
+        sh_size = 64 if i == bss_shndx else len(data)
+        elf.extend(struct.pack('<10I', sh_names[i], sh_type, sh_flags, 0,
+                sh_offsets[i], sh_size, sh_link, sh_info,
+                sh_addralign, sh_entsize))
+    e_ident = b'\x7fELF\x01\x01\x01' + bytes(9)
+    elf[:52] = e_ident + struct.pack('<HHIIIIIHHHHHH', 1, 94, 1, 0, 0,
+            e_shoff, 0, 52, 0, 0, 40, len(sections), len(sections)-1)
+    return bytes(elf)
+
+def load_corpus(corpus_dir, n_synthetic, export_list):
+    """
+    Returns an OrderedDict of corpus name to ELF contents
+    """
+    corpus = OrderedDict()
+    if corpus_dir is not None:
+        for fn in sorted(os.listdir(corpus_dir)):
+            if fn.endswith('.elf'):
+                with open(os.path.join(corpus_dir, fn), 'rb') as f:
+                    corpus[fn] = f.read()
+    for i in range(n_synthetic):
+        n_functions = 8 * 2**(i % 6)
+        leaf_ratio = 1.0 if i % 3 == 1 else 0.25
+        corpus['synthetic_%d.elf' % i] = synthetic_elf(n_functions, seed=i,
+                export_list=export_list, leaf_ratio=leaf_ratio)
+    return corpus
+
+def run_pipeline(mod, elf_contents, export_list, timings):
+    """
+    Runs the conversion stages of mod (elf2jelf or jelf_reference) the same
+    way convert_elf() does, adding each stage's runtime to timings.
+    returns: OrderedDict of stage name to stage output
+    """
+    outputs = OrderedDict()
+    def timed(stage, func, *args):
+        # Stages may modify their list/dict arguments, so repeat calls get
+        # fresh copies of what the first call was given
+        def copy_args(args):
+            return [deepcopy(arg) if isinstance(arg, (list, dict, bytearray))
+                    else arg for arg in args]
+        pristine = copy_args(args)
+        call_args = args
+        best = None
+        spent = 0
+        while best is None or spent < MIN_TIMED_SECONDS:
+            # Like timeit, keep garbage collection out of the timings
+            gc.disable()
+            try:
+                start = time.perf_counter()
+                call_result = func(*call_args)
+                elapsed = time.perf_counter() - start
+            finally:
+                gc.enable()
+            if best is None:
+                result = call_result
+                best = elapsed
+            best = min(best, elapsed)
+            spent += elapsed
+            call_args = copy_args(pristine)
+        timings[stage] = timings.get(stage, 0) + best
+        outputs[stage] = deepcopy(result)
+        return result
+
+    ehdr = mod.get_ehdr(elf_contents)
+    shstrtab = mod.get_shstrtab(elf_contents, ehdr)
+    elf32_shdrs, elf32_shdr_names, elf32_symtab, elf32_strtab = \
+            timed('read_section_headers', mod.read_section_headers,
+                    elf_contents, ehdr, shstrtab)
+    jelf_shdrs = timed('convert_shdrs', mod.convert_shdrs, elf32_shdrs)
+    jelf_symtab, jelf_entrypoint_sym_idx = timed('convert_symtab',
+            mod.convert_symtab, elf32_symtab, elf32_strtab, export_list)
+    jelf_relas, jelf_shdrs = timed('convert_relas', mod.convert_relas,
+            elf_contents, elf32_shdrs, jelf_shdrs)
+    jelf_contents, jelf_ptr, jelf_shdrs = timed('write_jelf_sections',
+            mod.write_jelf_sections, elf_contents,
+            elf32_shdrs, elf32_shdr_names,
+            jelf_shdrs, jelf_relas, jelf_symtab)
+    jelf_contents, jelf_ehdr_shnum = timed('write_jelf_sectionheadertable',
+            mod.write_jelf_sectionheadertable, jelf_contents,
+            jelf_shdrs, jelf_ptr)
+    timed('Unpacker', unpacker_roundtrip, mod, elf_contents, elf32_shdrs)
+
+    outputs['convert_elf'] = (jelf_contents, jelf_entrypoint_sym_idx,
+            jelf_ehdr_shnum, jelf_ptr)
+    return outputs
+
+def unpacker_roundtrip(mod, elf_contents, elf32_shdrs):
+    """
+    Unpacks every ELF32 RELA and packs it back; isolates Unpacker cost
+    """
+    rela_size = mod.Elf32_Rela.size_bytes()
+    packed = bytearray()
+    for shdr in elf32_shdrs:
+        if shdr.sh_type != mod.Elf32_SHT_RELA:
+            continue
+        for offset in range(shdr.sh_offset, shdr.sh_offset+shdr.sh_size,
+                rela_size):
+            rela = mod.Elf32_Rela.unpack(elf_contents[offset:offset+rela_size])
+            packed += mod.Elf32_Rela.pack(*rela)
+    return bytes(packed)
+
+def resolve_relocations(elf_contents, elf32_shdrs, elf32_symtab):
+    """
+    Resolves every relocation and symbol to the bytes it points at, so two
+    section layouts of the same program can be compared.
+    returns: (sorted relocations, symbols)
+    """
+    sym_size = elf2jelf.Elf32_Sym.size_bytes()
+    syms = [elf2jelf.Elf32_Sym.unpack(elf32_symtab[k:k+sym_size])
+            for k in range(0, len(elf32_symtab), sym_size)]
+
+    def location(shndx, offset):
+        if shndx == 0 or shndx >= elf2jelf.Elf32_SHN_LORESERVE:
+            return ('shndx', shndx)
+        shdr = elf32_shdrs[shndx]
+        if shdr.sh_type == elf2jelf.Elf32_SHT_NOBITS:
+            return ('nobits', shdr.sh_flags, offset < shdr.sh_size)
+        # A fragment may be followed by others once merged, so only the
+        # byte at offset is comparable
+        if offset >= shdr.sh_size:
+            return (shdr.sh_flags, None)
+        return (shdr.sh_flags, elf_contents[shdr.sh_offset+offset])
+
+    symbols = [(location(sym.st_shndx, sym.st_value), sym.st_name,
+            sym.st_info) for sym in syms]
+    relocations = []
+    rela_size = elf2jelf.Elf32_Rela.size_bytes()
+    for shdr in elf32_shdrs:
+        if shdr.sh_type != elf2jelf.Elf32_SHT_RELA:
+            continue
+        for k in range(shdr.sh_offset, shdr.sh_offset+shdr.sh_size,
+                rela_size):
+            rela = elf2jelf.Elf32_Rela.unpack(elf_contents[k:k+rela_size])
+            relocations.append((location(shdr.sh_info, rela.r_offset),
+                    rela.r_info, rela.r_addend))
+    return sorted(relocations), symbols
+
+def check_merge(elf_contents, export_list):
+    """
+    Checks that merge_sections() keeps every relocation and symbol pointing
+    at the same bytes, and that a merged conversion completes.
+    returns: None, or a description of the first problem
+    """
+    ehdr = elf2jelf.get_ehdr(elf_contents)
+    shstrtab = elf2jelf.get_shstrtab(elf_contents, ehdr)
+    elf32_shdrs, elf32_shdr_names, elf32_symtab, elf32_strtab = \
+            elf2jelf.read_section_headers(elf_contents, ehdr, shstrtab)
+    merged = elf2jelf.merge_sections(elf_contents, elf32_shdrs,
+            elf32_shdr_names, elf32_symtab)
+    merged_contents, merged_shdrs, merged_names, merged_symtab = merged
+
+    before = resolve_relocations(elf_contents, elf32_shdrs, elf32_symtab)
+    after = resolve_relocations(merged_contents, merged_shdrs, merged_symtab)
+    if before[1] != after[1]:
+        return "symbols: %s" % first_difference(before[1], after[1])
+    if before[0] != after[0]:
+        return "relocations: %s" % first_difference(before[0], after[0])
+    try:
+        elf2jelf.convert_elf(elf_contents, export_list, merge=True)
+    except Exception as e:
+        return "convert_elf(merge=True): %s: %s" % (type(e).__name__, e)
+    return None
+
+def sign_output(mod, name, converted, export_version):
+    """
+    Fills in a fixed JELF Header and signs; current signing uses the
+    SigningEngine's prehashed path, the reference uses libsodium directly.
+    """
+    jelf_contents, entry, shnum, shoff = converted
+    jelf_contents = bytearray(jelf_contents)
+    keystore = Keystore.from_seed(REGRESS_SEED)
+    pk = keystore.public_key('default')
+    jelf_ehdr_d = OrderedDict()
+    jelf_ehdr_d['e_ident']          = '\x7fJELF\x00'
+    jelf_ehdr_d['e_signature']      = b'\x00'*64
+    jelf_ehdr_d['e_public_key']     = pk
+    jelf_ehdr_d['e_version_major']  = export_version[0]
+    jelf_ehdr_d['e_version_minor']  = export_version[1]
+    jelf_ehdr_d['e_entry_offset']   = entry
+    jelf_ehdr_d['e_shnum']          = shnum
+    jelf_ehdr_d['e_shoff']          = shoff
+    jelf_ehdr_d['e_coin_purpose']   = 44 | elf2jelf.HARDEN
+    jelf_ehdr_d['e_coin_path']      = 165 | elf2jelf.HARDEN
+    jelf_ehdr_d['e_bip32key']       = 'ed25519 seed'
+    name_to_sign = os.path.splitext(name)[0].encode('utf-8')
+    if mod is jelf_reference:
+        jelf_reference.sign_jelf(jelf_contents, jelf_ehdr_d, name_to_sign,
+                REGRESS_SEED, pk)
+    else:
+        jelf_contents[:elf2jelf.Jelf_Ehdr.size_bytes()] = \
+                elf2jelf.Jelf_Ehdr.pack( *jelf_ehdr_d.values() )
+        jelf_ehdr_d['e_signature'] = keystore.sign('default',
+                elf2jelf.prehash(name_to_sign, jelf_contents))
+        jelf_contents[:elf2jelf.Jelf_Ehdr.size_bytes()] = \
+                elf2jelf.Jelf_Ehdr.pack( *jelf_ehdr_d.values() )
+    return bytes(jelf_contents)
+
+def first_difference(a, b):
+    """
+    Describes where two stage outputs diverge
+    """
+    if isinstance(a, (bytes, bytearray)) and isinstance(b, (bytes, bytearray)):
+        for i, (x, y) in enumerate(zip(a, b)):
+            if x != y:
+                return "byte 0x%X (0x%02X != 0x%02X)" % (i, x, y)
+        return "length %d != %d" % (len(a), len(b))
+    if isinstance(a, (tuple, list)) and isinstance(b, (tuple, list)) \
+            and len(a) == len(b):
+        for i, (x, y) in enumerate(zip(a, b)):
+            if x != y:
+                return "element %d: %s" % (i, first_difference(x, y))
+    return "%.60r != %.60r" % (a, b)
+
+def check_corpus(corpus, export_list, export_version, repeat):
+    """
+    Returns (list of equivalence failures,
+            per-stage seconds for current, per-stage seconds for reference,
+            per-stage list of each file's speedup over reference)
+    """
+    failures = []
+    current_t = {}
+    reference_t = {}
+    file_speedups = {stage: [] for stage in STAGES}
+    for name, elf_contents in corpus.items():
+        best_current, best_reference = {}, {}
+        for _ in range(repeat):
+            t = {}
+            current = run_pipeline(elf2jelf, elf_contents, export_list, t)
+            for stage, sec in t.items():
+                best_current[stage] = min(sec, best_current.get(stage, sec))
+            t = {}
+            reference = run_pipeline(jelf_reference, elf_contents,
+                    export_list, t)
+            for stage, sec in t.items():
+                best_reference[stage] = min(sec, best_reference.get(stage, sec))
+        for stage in STAGES:
+            current_t[stage] = current_t.get(stage, 0) + best_current[stage]
+            reference_t[stage] = reference_t.get(stage, 0) \
+                    + best_reference[stage]
+            file_speedups[stage].append(best_reference[stage]
+                    / max(best_current[stage], 1e-9))
+
+        for stage in reference:
+            if current[stage] != reference[stage]:
+                failures.append((name, stage,
+                    first_difference(current[stage], reference[stage])))
+        if sign_output(elf2jelf, name, current['convert_elf'],
+                export_version) != sign_output(jelf_reference, name,
+                reference['convert_elf'], export_version):
+            failures.append((name, 'signed JELF', 'outputs differ'))
+        merge_failure = check_merge(elf_contents, export_list)
+        if merge_failure is not None:
+            failures.append((name, 'merge_sections', merge_failure))
+    return failures, current_t, reference_t, file_speedups
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+            description='JELF conversion equivalence and throughput gate')
+    parser.add_argument('--corpus', type=str, default=None,
+            help='Directory of real *.elf files to include in the corpus')
+    parser.add_argument('--synthetic', type=int, default=12,
+            help='Number of synthetic ELFs to add to the corpus')
+    parser.add_argument('--baseline', type=str,
+            default=os.path.join(this_path, 'regress_baseline.json'),
+            help='Stored per-stage speedup baseline (JSON)')
+    parser.add_argument('--update_baseline', action='store_true',
+            help='Store this run\'s speedups as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.20,
+            help='''
+            Maximum allowed fractional drop in a stage's speedup over the
+            reference against the baseline before failing; 0.20 allows a
+            stage to lose 20%% of its speedup. Repeated runs of the default
+            corpus stay within 5%% of each other.''')
+    parser.add_argument('--repeat', type=int, default=3,
+            help='Runs per corpus file; the fastest run of each stage counts')
+    args = parser.parse_args()
+    return args
+
+def main():
+    args = parse_args()
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    # Stage debug logging would dominate the timings
+    logging.getLogger('elf2jelf').setLevel(logging.WARNING)
+    logging.getLogger('jelf_reference').setLevel(logging.WARNING)
+
+    export_list, major, minor = elf2jelf.read_export_list()
+    corpus = load_corpus(args.corpus, args.synthetic, export_list)
+    if not corpus:
+        log.error("Empty corpus")
+        return 1
+    n_bytes = sum(len(elf) for elf in corpus.values())
+    log.info("Corpus: %d ELF files, %d bytes" % (len(corpus), n_bytes))
+
+    failures, current_t, reference_t, file_speedups = check_corpus(corpus,
+            export_list, (major, minor), args.repeat)
+    for name, stage, detail in failures:
+        log.error("MISMATCH %s at %s: %s" % (name, stage, detail))
+
+    throughput = OrderedDict( (stage, n_bytes / max(current_t[stage], 1e-9)
+            / 1e6) for stage in STAGES )
+    # The median over files isn't thrown off by a noisy run of the largest
+    # files, which would dominate a corpus-wide ratio
+    speedups = OrderedDict( (stage, statistics.median(file_speedups[stage]))
+            for stage in STAGES )
+    baseline = None
+    if args.update_baseline:
+        pass
+    elif not os.path.exists(args.baseline):
+        log.error("No baseline at %s; run with --update_baseline" % \
+                args.baseline)
+    else:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline['corpus_bytes'] != n_bytes:
+            log.warning("Baseline was recorded on a different corpus")
+        baseline = baseline['speedup']
+
+    regressions = []
+    log.info("%-30s %12s %12s %12s" % ('stage', 'MB/s', 'vs reference',
+            'vs baseline'))
+    for stage in STAGES:
+        vs_baseline = ''
+        if baseline is not None:
+            if stage not in baseline:
+                log.error("Stage %s not in baseline" % stage)
+                regressions.append((stage, 0))
+                continue
+            ratio = speedups[stage] / baseline[stage]
+            vs_baseline = '%.2fx' % ratio
+            if ratio < 1 - args.threshold:
+                regressions.append((stage, ratio))
+        log.info("%-30s %12.3f %11.2fx %12s" % (stage, throughput[stage],
+                speedups[stage], vs_baseline))
+    for stage, ratio in regressions:
+        log.error("REGRESSION %s speedup over reference is %.0f%% of "
+                "baseline" % (stage, 100*ratio))
+
+    if args.update_baseline:
+        if failures:
+            log.error("Not updating baseline; outputs are not equivalent")
+        else:
+            with open(args.baseline, 'w') as f:
+                json.dump({'corpus_bytes': n_bytes, 'speedup': speedups,
+                        'throughput': throughput}, f, indent=4)
+            log.info("Wrote baseline to %s" % args.baseline)
+
+    if failures or regressions or (baseline is None
+            and not args.update_baseline):
+        log.error("FAIL")
+        return 1
+    log.info("PASS")
+    return 0
+
+if __name__=='__main__':
+    sys.exit(main())
@@ -23,6 +23,12 @@ _Jelf_Ehdr_d['e_coin_path']      = 'u32'
 _Jelf_Ehdr_d['e_bip32key']       = 't%d' % (32*8)
 Jelf_Ehdr = Unpacker( 'Jelf_Ehdr', _Jelf_Ehdr_d )
 
+JELF_IDENT         = '\x7fJELF\x00'
+# Symtab st_name indexes the import table in the symtab's sh_info section
+# instead of the export list. A distinct magic so that loaders without
+# import table support reject the file instead of binding the wrong exports.
+JELF_IDENT_IMPORTS = '\x7fJELF\x01'
+
 '''
 JELF Section Header
 '''
@@ -51,6 +57,14 @@ _Jelf_Sym_d['st_shndx']   = 'u16'
 _Jelf_Sym_d['st_value']   = 'u32'
 Jelf_Sym = Unpacker( 'Jelf_Sym', _Jelf_Sym_d )
 
+'''
+JELF Import Table Entry
+1-indexed export list index of a function the app uses
+'''
+_Jelf_Import_d = OrderedDict()
+_Jelf_Import_d['i_name']  = 'u16'
+Jelf_Import = Unpacker( 'Jelf_Import', _Jelf_Import_d )
+
 '''
 RELA
 '''
@@ -64,3 +78,26 @@ Jelf_R_XTENSA_NONE       = 0
 Jelf_R_XTENSA_32         = 1
 Jelf_R_XTENSA_ASM_EXPAND = 2
 Jelf_R_XTENSA_SLOT0_OP   = 3
+
+'''
+JELF Bundle Header
+Several JELF files packed into one container; see jelf_bundle.py
+'''
+_Jelf_Bundle_Hdr_d = OrderedDict()
+_Jelf_Bundle_Hdr_d['b_ident']          = 't%d' % (6*8) # 6 8-bit characters
+_Jelf_Bundle_Hdr_d['b_version_major']  = 'u8'
+_Jelf_Bundle_Hdr_d['b_version_minor']  = 'u8'
+_Jelf_Bundle_Hdr_d['b_nentries']       = 'u16'
+_Jelf_Bundle_Hdr_d['b_dict_offset']    = 'u32'
+_Jelf_Bundle_Hdr_d['b_dict_size']      = 'u32'
+Jelf_Bundle_Hdr = Unpacker( 'Jelf_Bundle_Hdr', _Jelf_Bundle_Hdr_d )
+
+'''
+JELF Bundle Index Entry
+'''
+_Jelf_Bundle_Entry_d = OrderedDict()
+_Jelf_Bundle_Entry_d['be_name']        = 't%d' % (32*8)
+_Jelf_Bundle_Entry_d['be_offset']      = 'u32'
+_Jelf_Bundle_Entry_d['be_zsize']       = 'u32'
+_Jelf_Bundle_Entry_d['be_size']        = 'u32'
+Jelf_Bundle_Entry = Unpacker( 'Jelf_Bundle_Entry', _Jelf_Bundle_Entry_d )
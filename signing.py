@@ -0,0 +1,270 @@
+'''
+Signing engine for JELF files.
+
+Secret keys are loaded once from a local keystore (or held by a local signing
+daemon) and never passed to conversion workers. Workers only compute the
+ed25519ph prehash (SHA-512 over the application name followed by the JELF
+contents) and hand the 64-byte digest to the engine, which signs queued
+digests concurrently.
+
+Keystore file format (JSON, should only be readable by its owner):
+    {
+        "dev":  "<64 hex characters; 256-bit ed25519 seed>",
+        "prod": "<64 hex characters; 256-bit ed25519 seed>"
+    }
+
+Run a signing daemon that serves a keystore over a unix socket:
+    python3 signing.py keys.json --socket /tmp/jelf_signer.sock
+
+Daemon protocol (one request per line, ascii):
+    PUBKEY <key_name>              -> OK <hex public key>
+    SIGN <key_name> <hex digest>   -> OK <hex signature>
+    any failure                    -> ERR <message>
+'''
+
+import argparse
+import os, sys
+import stat
+import json
+import hashlib
+import logging
+import socket
+import socketserver
+import threading
+from binascii import hexlify, unhexlify
+from concurrent.futures import ThreadPoolExecutor
+
+from nacl.bindings import \
+        crypto_sign_seed_keypair, \
+        crypto_core_ed25519_scalar_reduce, \
+        crypto_core_ed25519_scalar_mul, \
+        crypto_core_ed25519_scalar_add, \
+        crypto_scalarmult_ed25519_base_noclamp
+
+log = logging.getLogger('signing')
+
+# dom2(phflag=1, context='') from RFC 8032
+_ED25519PH_DOM = b'SigEd25519 no Ed25519 collisions' + b'\x01' + b'\x00'
+
+DEFAULT_KEY_NAME = 'default'
+
+def prehash(name_to_sign, jelf_contents):
+    """
+    Returns the ed25519ph prehash of a JELF file; the same message that
+    main() feeds into crypto_sign_ed25519ph_update.
+    """
+    h = hashlib.sha512()
+    h.update(name_to_sign)
+    h.update(bytes(jelf_contents))
+    return h.digest()
+
+class SigningKey:
+    """
+    ed25519 key expanded once so that each signature only costs the
+    per-message hashes and one scalar multiplication.
+    """
+    def __init__(self, seed):
+        if len(seed) != 32:
+            raise ValueError("ed25519 seed must be 32 bytes")
+        pk, _ = crypto_sign_seed_keypair(seed)
+        h = hashlib.sha512(seed).digest()
+        scalar = bytearray(h[:32])
+        scalar[0]  &= 248
+        scalar[31] &= 127
+        scalar[31] |= 64
+        self.public_key = pk
+        self._scalar = crypto_core_ed25519_scalar_reduce(bytes(scalar) + bytes(32))
+        self._nonce_prefix = h[32:]
+
+    def sign_prehashed(self, digest):
+        """
+        Returns the 64-byte ed25519ph signature of a SHA-512 digest.
+        Identical to crypto_sign_ed25519ph_final_create over the same message.
+        """
+        if len(digest) != 64:
+            raise ValueError("ed25519ph digest must be 64 bytes")
+        r = crypto_core_ed25519_scalar_reduce( hashlib.sha512(
+                _ED25519PH_DOM + self._nonce_prefix + digest).digest() )
+        R = crypto_scalarmult_ed25519_base_noclamp(r)
+        k = crypto_core_ed25519_scalar_reduce( hashlib.sha512(
+                _ED25519PH_DOM + R + self.public_key + digest).digest() )
+        S = crypto_core_ed25519_scalar_add(r,
+                crypto_core_ed25519_scalar_mul(k, self._scalar))
+        return R + S
+
+class Keystore:
+    """
+    Named SigningKeys; local stand-in for an HSM.
+    """
+    def __init__(self, keys=None):
+        self.keys = keys if keys is not None else {}
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a JSON keystore file mapping key names to hex seeds
+        """
+        mode = os.stat(path).st_mode
+        if mode & (stat.S_IRWXG | stat.S_IRWXO):
+            log.warning("Keystore %s is accessible by other users" % path)
+        with open(path, 'r') as f:
+            hex_seeds = json.load(f)
+        keys = {name: SigningKey(unhexlify(seed))
+                for name, seed in hex_seeds.items()}
+        log.info("Loaded %d key(s) from %s" % (len(keys), path))
+        return cls(keys)
+
+    @classmethod
+    def from_seed(cls, seed, name=DEFAULT_KEY_NAME):
+        return cls({name: SigningKey(seed)})
+
+    def _get(self, key_name):
+        try:
+            return self.keys[key_name]
+        except KeyError:
+            raise KeyError("Key \"%s\" not in keystore" % key_name)
+
+    def public_key(self, key_name):
+        return self._get(key_name).public_key
+
+    def sign(self, key_name, digest):
+        return self._get(key_name).sign_prehashed(digest)
+
+class DaemonSigner:
+    """
+    Client for a SigningDaemon; same interface as Keystore.
+    Each thread keeps its own connection to the daemon.
+    """
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self._local = threading.local()
+
+    def _request(self, *fields):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.socket_path)
+            conn = sock.makefile('rwb')
+            self._local.conn = conn
+        conn.write(' '.join(fields).encode('ascii') + b'\n')
+        conn.flush()
+        response = conn.readline().decode('ascii').rstrip()
+        if not response:
+            raise ConnectionError("Signing daemon closed the connection")
+        status, _, value = response.partition(' ')
+        if status != 'OK':
+            raise RuntimeError("Signing daemon: %s" % value)
+        return unhexlify(value)
+
+    def public_key(self, key_name):
+        return self._request('PUBKEY', key_name)
+
+    def sign(self, key_name, digest):
+        return self._request('SIGN', key_name,
+                hexlify(digest).decode('ascii'))
+
+class _SigningRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        keystore = self.server.keystore
+        for line in self.rfile:
+            fields = line.decode('ascii', 'replace').split()
+            try:
+                if len(fields) == 2 and fields[0] == 'PUBKEY':
+                    value = keystore.public_key(fields[1])
+                elif len(fields) == 3 and fields[0] == 'SIGN':
+                    value = keystore.sign(fields[1], unhexlify(fields[2]))
+                    log.debug("Signed digest with key %s" % fields[1])
+                else:
+                    raise ValueError("Malformed request")
+                response = 'OK ' + hexlify(value).decode('ascii')
+            except Exception as e:
+                response = 'ERR %s' % str(e).replace('\n', ' ')
+            self.wfile.write(response.encode('ascii') + b'\n')
+
+class SigningDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves a Keystore over a unix socket, HSM-style
+    """
+    daemon_threads = True
+
+    def __init__(self, keystore, socket_path):
+        self.keystore = keystore
+        # Only replace a stale socket; never a file given by mistake
+        try:
+            mode = os.lstat(socket_path).st_mode
+        except FileNotFoundError:
+            pass
+        else:
+            if not stat.S_ISSOCK(mode):
+                raise FileExistsError("%s exists and is not a socket" % \
+                        socket_path)
+            os.unlink(socket_path)
+        # Bind under a umask so the socket is never reachable by other users
+        old_umask = os.umask(stat.S_IXUSR | stat.S_IRWXG | stat.S_IRWXO)
+        try:
+            socketserver.UnixStreamServer.__init__(self, socket_path,
+                    _SigningRequestHandler)
+        finally:
+            os.umask(old_umask)
+
+class SigningEngine:
+    """
+    Signs queued digests concurrently using a Keystore or DaemonSigner.
+    """
+    def __init__(self, signer, max_workers=None):
+        self.signer = signer
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def public_key(self, key_name):
+        return self.signer.public_key(key_name)
+
+    def submit(self, key_name, digest):
+        """
+        Queues a digest for signing; returns a Future of the signature
+        """
+        return self._executor.submit(self.signer.sign, key_name, digest)
+
+    def sign_all(self, requests):
+        """
+        Signs an iterable of (key_name, digest); returns signatures in order
+        """
+        futures = [self.submit(key_name, digest)
+                for key_name, digest in requests]
+        return [future.result() for future in futures]
+
+    def close(self):
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+            description='Serve a JELF signing keystore over a unix socket')
+    parser.add_argument('keystore', type=str,
+            help='JSON keystore file')
+    parser.add_argument('--socket', '-s', type=str,
+            default='/tmp/jelf_signer.sock',
+            help='Unix socket path to listen on')
+    args = parser.parse_args()
+    return args
+
+def main():
+    args = parse_args()
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    keystore = Keystore.load(args.keystore)
+    server = SigningDaemon(keystore, args.socket)
+    log.info("Listening on %s" % args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+
+if __name__=='__main__':
+    main()